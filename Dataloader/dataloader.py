@@ -1,9 +1,12 @@
 import numpy as np
 import random
+from collections import OrderedDict
 import matplotlib.pyplot as plt
+import os
 from os import listdir
-from os.path import join
+from os.path import join, exists
 from scipy import io as sio
+from scipy import fft as sfft
 from Utils.utils import ri2ssos, ri2complex, complex2ri, fft2c, ifft2c
 
 
@@ -35,6 +38,15 @@ class Dataloader:
         self.R = opt.R
         self.N = opt.N
         self.augmentation = opt.augmentation
+        self.compact_mask = getattr(opt, 'compact_mask', False)  # return row/column masks instead of full HxW masks
+        self.kspace_cache_dir = getattr(opt, 'kspace_cache_dir', '')  # precomputed centered k-space, empty to disable
+        self.kspace_stores = {}
+        self.fft_workers = getattr(opt, 'fft_workers', -1)  # threads of the batched FFTs, -1 uses all cores
+        self.read_cache_bytes = int(getattr(opt, 'read_cache_mb', 1024) * 2 ** 20)  # decoded slices kept, 0 to disable
+        self.read_cache = OrderedDict()
+        self.read_cache_size = 0
+        self.read_hits = 0
+        self.read_misses = 0
         self.phase = phase
         self.len = len(self.flist_F)
 
@@ -79,6 +91,112 @@ class Dataloader:
         slice = data[100:420, 100:420]
         return slice
 
+    def load_mat(self, filename):
+        """
+        read_mat through a size-bounded LRU cache of decoded slices keyed by path
+        :param filename: the name of the file
+        :return: read-only output numpy array of read_mat
+        """
+        aSlice = self.read_cache.get(filename)
+        if aSlice is not None:
+            self.read_hits += 1
+            self.read_cache.move_to_end(filename)
+            return aSlice
+        self.read_misses += 1
+        aSlice = np.array(self.read_mat(filename))  # a copy, the crop must not keep the whole decoded matrix alive
+        if aSlice.nbytes > self.read_cache_bytes:
+            return aSlice
+        aSlice.flags.writeable = False
+        self.read_cache[filename] = aSlice
+        self.read_cache_size += aSlice.nbytes
+        while self.read_cache_size > self.read_cache_bytes:
+            self.read_cache_size -= self.read_cache.popitem(last=False)[1].nbytes
+        return aSlice
+
+    def read_cache_stats(self):
+        """
+        :return: dict with the hits, misses, entries and bytes of the read_mat cache
+        """
+        return {'hits': self.read_hits, 'misses': self.read_misses,
+                'entries': len(self.read_cache), 'bytes': self.read_cache_size}
+
+    @staticmethod
+    def compute_kspace(inp, mode='magnitude'):
+        """
+        Centered k-space of an image
+        :param inp: 2D (HW) magnitude image or 3D (HWC) concatenated real/imaginary image
+        :param mode: string, magnitude or complex
+        :return: 2D (HW) or 3D (HWC/2) complex numpy array
+        """
+        if mode == 'magnitude':
+            return np.fft.fftshift(np.fft.fft2(inp))
+        return np.fft.fftshift(fft2c(ri2complex(inp)), axes=[0, 1])
+
+    def kspace(self, filename, mode='magnitude', inp=None):
+        """
+        Centered k-space of read_mat(filename). With opt.kspace_cache_dir it is read from the
+        memory-mapped k-space cache, so only the inverse transform remains after masking.
+        :param filename: the name of the file
+        :param mode: string, magnitude or complex
+        :param inp: the image of the file if already read, saves a read when there is no cache
+        :return: 2D (HW) or 3D (HWC/2) complex numpy array
+        """
+        if not self.kspace_cache_dir:
+            return self.compute_kspace(self.load_mat(filename) if inp is None else inp, mode)
+        if mode not in self.kspace_stores:
+            self.kspace_stores[mode] = self.open_kspace_cache(mode)
+        store, rows = self.kspace_stores[mode]
+        return store[rows[filename]]
+
+    def kspace_batch(self, filenames, mode='magnitude', inp=None):
+        """
+        Stacked centered k-space of a list of files, see kspace
+        :param filenames: list of file names
+        :param mode: string, magnitude or complex
+        :param inp: 3D (BHW) or 4D (BHWC) stacked images of the files if already read
+        :return: 3D (BHW) or 4D (BHWC/2) complex numpy array
+        """
+        if self.kspace_cache_dir:
+            if mode not in self.kspace_stores:
+                self.kspace_stores[mode] = self.open_kspace_cache(mode)
+            store, rows = self.kspace_stores[mode]
+            return store[[rows[f] for f in filenames]]
+        if inp is None:
+            inp = np.stack([self.load_mat(f) for f in filenames])
+        if mode == 'magnitude':
+            return np.fft.fftshift(sfft.fft2(inp, axes=(1, 2), workers=self.fft_workers), axes=(1, 2))
+        return np.stack([self.compute_kspace(aInput, mode) for aInput in inp])
+
+    def open_kspace_cache(self, mode):
+        """
+        Open the k-space cache of this phase, (re)building it when files were added, removed or rewritten
+        :param mode: string, magnitude or complex
+        :return: (memory-mapped complex64 array with one k-space per file, dict filename -> row)
+        """
+        flist = sorted(set(self.flist_F))
+        stamps = np.array([[os.stat(f).st_mtime_ns, os.stat(f).st_size] for f in flist], dtype=np.int64)
+        prefix = join(self.kspace_cache_dir, '{}_{}_kspace'.format(self.phase, mode))
+        rows = dict((f, i) for i, f in enumerate(flist))
+
+        if exists(prefix + '.npy') and exists(prefix + '_index.npz'):
+            index = np.load(prefix + '_index.npz')
+            if index['flist'].tolist() == flist and np.array_equal(index['stamps'], stamps):
+                return np.load(prefix + '.npy', mmap_mode='r'), rows
+
+        if not exists(self.kspace_cache_dir):
+            os.makedirs(self.kspace_cache_dir)
+        first = self.compute_kspace(self.read_mat(flist[0]), mode)
+        store = np.lib.format.open_memmap(prefix + '.tmp.npy', mode='w+', dtype=np.complex64,
+                                          shape=(len(flist),) + first.shape)
+        store[0] = first
+        for i in range(1, len(flist)):
+            store[i] = self.compute_kspace(self.read_mat(flist[i]), mode)
+        store.flush()
+        del store
+        os.replace(prefix + '.tmp.npy', prefix + '.npy')
+        np.savez(prefix + '_index.npz', flist=np.array(flist), stamps=stamps)
+        return np.load(prefix + '.npy', mmap_mode='r'), rows
+
     @staticmethod
     def read_test_mat(filename):
         """
@@ -94,15 +212,16 @@ class Dataloader:
         return slice
 
     @staticmethod
-    def make_mask(inp, R):
+    def make_mask(inp, R, compact=False):
         """
         Make subsampling mask (1D Cartesian trajectory, Gaussian random sampling)
         :param inp: 3D (HWC) output numpy array
         :param R: integer, downsampling rate
+        :param compact: return the (H,1) row mask, it broadcasts against (H,W) k-space
         :return: 3D (HWC) output numpy array
         """
         nY = np.shape(inp)[0]
-        nX = np.shape(inp)[1]
+        nX = 1 if compact else np.shape(inp)[1]
         mask = np.zeros((nY, nX), dtype=np.float32)
 
         nACS = round(nY / (R ** 2))
@@ -117,14 +236,15 @@ class Dataloader:
         return mask
 
     @staticmethod
-    def make_mask_X(inp, R):
+    def make_mask_X(inp, R, compact=False):
         """
         Make subsampling mask (1D Cartesian trajectory, Gaussian random sampling)
         :param inp: 3D (HWC) output numpy array
         :param R: integer, downsampling rate
+        :param compact: return the (1,W) column mask, it broadcasts against (H,W) k-space
         :return: 3D (HWC) output numpy array
         """
-        nY = np.shape(inp)[0]
+        nY = 1 if compact else np.shape(inp)[0]
         nX = np.shape(inp)[1]
         mask = np.zeros((nY, nX), dtype=np.float32)
 
@@ -139,6 +259,44 @@ class Dataloader:
         mask[:, r.tolist()] = 1
         return mask
 
+    @staticmethod
+    def make_mask_lines(n, nL, R):
+        """
+        Make n subsampling masks at once (1D Cartesian trajectory, Gaussian random sampling), same law as make_mask
+        :param n: integer, number of masks
+        :param nL: integer, number of phase-encoding lines
+        :param R: integer, downsampling rate
+        :return: 2D (n, nL) output numpy array, 1 for the sampled lines
+        """
+        lines = np.zeros((n, nL), dtype=np.float32)
+
+        nACS = round(nL / (R ** 2))
+        ACS_s = round((nL - nACS) / 2)
+        lines[:, ACS_s:ACS_s + nACS] = 1
+
+        nSamples = int(nL / R)
+        r = np.floor(np.random.normal(nL / 2, 70, (n, nSamples)))
+        r = np.clip(r.astype(int), 0, nL - 1)
+        lines[np.arange(n)[:, np.newaxis], r] = 1
+        return lines
+
+    def undersample_magnitude(self, filenames, masks, inp=None):
+        """
+        Magnitude images of the files undersampled with row masks, |ifft2(ifftshift(fftshift(fft2(img)) * mask))|
+        :param filenames: list of file names
+        :param masks: 3D (BH1) row masks
+        :param inp: 3D (BHW) stacked images of the files if already read
+        :return: 3D (BHW) output numpy array
+        """
+        if self.kspace_cache_dir:
+            k_down = self.kspace_batch(filenames) * masks
+            return np.abs(sfft.ifft2(np.fft.ifftshift(k_down, axes=(1, 2)), axes=(1, 2), workers=self.fft_workers))
+        if inp is None:
+            inp = np.stack([self.load_mat(f) for f in filenames]).astype(np.float32)
+        # the masks are constant along x, so the FFT pair along x cancels and the shifts only move the mask
+        k_down = sfft.fft(inp, axis=1, workers=self.fft_workers) * np.fft.ifftshift(masks, axes=1)
+        return np.abs(sfft.ifft(k_down, axis=1, overwrite_x=True, workers=self.fft_workers))
+
     def getBatch_magnitude(self, start, end):
         """
         Make and return batch data (for magnitude image)
@@ -151,7 +309,7 @@ class Dataloader:
         batch_D = self.flist_D[start:end]
 
         size_input = [end - start, self.nY, self.nX, self.nC]
-        size_mask = size_input
+        size_mask = [end - start, self.nY, 1 if self.compact_mask else self.nX, self.nC]
 
         Input_F = np.empty(size_input, dtype=np.float32)
         Mask_F = np.empty(size_mask, dtype=np.float32)
@@ -159,37 +317,41 @@ class Dataloader:
         Input_D = np.empty(size_input, dtype=np.float32)
         Mask_D = np.empty(size_mask, dtype=np.float32)
 
-        for iB in range(len(batch_F)):
-            aInput_F = self.read_mat(batch_F[iB])  # magnitude image
-            aInput_D = self.read_mat(batch_D[iB])  # magnitude image
+        nB = len(batch_F)
+        aInput_F = np.stack([self.load_mat(f) for f in batch_F]).astype(np.float32)  # magnitude images
 
-            aMask_F = self.make_mask(aInput_F, self.R)
-            aMask_D = self.make_mask(aInput_D, self.R)
+        aMask_F = self.make_mask_lines(nB, self.nY, self.R)[:, :, np.newaxis]  # (B,H,1) row masks
+        aMask_D = self.make_mask_lines(nB, self.nY, self.R)[:, :, np.newaxis]
 
-            k_orig_F = np.fft.fftshift(np.fft.fft2(aInput_F))
-            k_down_F = k_orig_F * aMask_F
-            tmp = np.abs(np.fft.ifft2(np.fft.ifftshift(k_down_F)))
+        tmp = self.undersample_magnitude(batch_F, aMask_F, aInput_F)
+        aInput_D = self.undersample_magnitude(batch_D, aMask_D)  # the downsampled domain only needs k-space
 
-            k_orig_D = np.fft.fftshift(np.fft.fft2(aInput_D))
-            k_down_D = k_orig_D * aMask_D
-            aInput_D = np.abs(np.fft.ifft2(np.fft.ifftshift(k_down_D)))
+        aScale_F = np.std(tmp, axis=(1, 2), keepdims=True)
+        Input_F[:, :, :, 0] = aInput_F / aScale_F
+        aScale_D = np.std(aInput_D, axis=(1, 2), keepdims=True)
+        Input_D[:, :, :, 0] = aInput_D / aScale_D
+        Mask_F[:, :, :, 0] = aMask_F
+        Mask_D[:, :, :, 0] = aMask_D
 
-            aScale_F = np.std(tmp)
-            aInput_F = aInput_F / aScale_F
-            aScale_D = np.std(aInput_D)
-            aInput_D = aInput_D / aScale_D
-
-            if self.phase == 'train' and self.augmentation:
-                aInput_F, aMask_F = self.augment_data(aInput_F, aMask_F)
-                aInput_D, aMask_D = self.augment_data(aInput_D, aMask_D)
-
-            Input_F[iB, :, :, 0] = aInput_F
-            Input_D[iB, :, :, 0] = aInput_D
-            Mask_F[iB, :, :, 0] = aMask_F
-            Mask_D[iB, :, :, 0] = aMask_D
+        if self.phase == 'train' and self.augmentation:
+            for iB in range(nB):
+                Input_F[iB], Mask_F[iB] = self.augment_data(Input_F[iB], Mask_F[iB])
+                Input_D[iB], Mask_D[iB] = self.augment_data(Input_D[iB], Mask_D[iB])
 
         return Input_F, Mask_F, Input_D, Mask_D
 
+    def bootstrap_magnitude(self, k_orig):
+        """
+        Undersample one centered k-space with N random masks at once (bootstrap aggregation)
+        :param k_orig: 2D (HW) centered k-space
+        :return: 3D (NHW) magnitude images scaled by their std, 1D (N) scales, 3D (NH1) row masks
+        """
+        masks = np.stack([self.make_mask(k_orig, self.R, compact=True) for _ in range(self.N)])
+        k_down = k_orig[np.newaxis] * masks  # (N,H,W), row masks broadcast along x
+        images = np.abs(np.fft.ifft2(np.fft.ifftshift(k_down, axes=(-2, -1))))
+        scales = np.std(images, axis=(1, 2))
+        return images / scales[:, np.newaxis, np.newaxis], scales, masks
+
     def getBatch_magnitude_test(self, idx):
         """
         Make and return batch data (for magnitude image, inference)
@@ -203,23 +365,15 @@ class Dataloader:
         Input_D = np.empty(size_input, dtype=np.float32)
         Scale_D = np.empty(size_input, dtype=np.float32)
 
-        for iB in range(self.N):
-            aInput_D = self.read_mat(batch_D)  # magnitude image with motion artifact
-
-            aMask_D = self.make_mask(aInput_D, self.R)
-
-            k_orig_D = np.fft.fftshift(np.fft.fft2(aInput_D))
-            k_down_D = k_orig_D * aMask_D
-            aInput_D = np.abs(np.fft.ifft2(np.fft.ifftshift(k_down_D)))
-
-            aScale_D = np.std(aInput_D)
-            aInput_D = aInput_D / aScale_D
+        k_orig_D = self.kspace(batch_D)  # magnitude image with motion artifact, transformed once
+        aInput_D, aScale_D, aMask_D = self.bootstrap_magnitude(k_orig_D)
 
+        for iB in range(self.N):
             if self.phase == 'train' and self.augmentation:
-                aInput_D, aMask_D = self.augment_data(aInput_D, aMask_D)
+                aInput_D[iB], aMask_D[iB] = self.augment_data(aInput_D[iB], aMask_D[iB])
 
-            Input_D[iB, :, :, 0] = aInput_D
-            Scale_D[iB, :, :, 0] = np.tile(aScale_D, [self.nY, self.nX])
+        Input_D[:, :, :, 0] = aInput_D
+        Scale_D[:, :, :, 0] = aScale_D[:, np.newaxis, np.newaxis]
 
         return Input_D, Scale_D
 
@@ -239,30 +393,18 @@ class Dataloader:
         Scale_D = np.empty(size_input, dtype=np.float32)
 
         for iC in range(aInput_D_C.shape[0]):
-            aInput_D = aInput_D_C[iC, :, :]
             # if iC==30:
                 # plt.figure(1)
-                # plt.imshow(np.squeeze(aInput_D), cmap="gray")
-            for iB in range(self.N):
-                aMask_D = self.make_mask(aInput_D, self.R)
-
-                # plt.figure(iB+2,figsize=(1200,1200),dpi=1800)
-                # plt.subplot(1,2,1)
-                # plt.imshow(np.squeeze(aMask_D), cmap="gray")
-                k_orig_D = np.fft.fftshift(np.fft.fft2(aInput_D))
-                k_down_D = k_orig_D * aMask_D
-                aInput_D = np.abs(np.fft.ifft2(np.fft.ifftshift(k_down_D)))
-
-                # plt.subplot(1, 2, 2)
-                # plt.imshow(np.squeeze(aInput_D), cmap="gray")
-                aScale_D = np.std(aInput_D)
-                aInput_D = aInput_D / aScale_D
+                # plt.imshow(np.squeeze(aInput_D_C[iC]), cmap="gray")
+            k_orig_D = np.fft.fftshift(np.fft.fft2(aInput_D_C[iC, :, :]))  # one forward FFT per coil
+            aInput_D, aScale_D, aMask_D = self.bootstrap_magnitude(k_orig_D)
 
+            for iB in range(self.N):
                 if self.phase == 'train' and self.augmentation:
-                    aInput_D, aMask_D = self.augment_data(aInput_D, aMask_D)
+                    aInput_D[iB], aMask_D[iB] = self.augment_data(aInput_D[iB], aMask_D[iB])
 
-                Input_D[iB, :, :, iC] = aInput_D
-                Scale_D[iB, :, :, iC] = np.tile(aScale_D, [self.nY, self.nX])
+            Input_D[:, :, :, iC] = aInput_D
+            Scale_D[:, :, :, iC] = aScale_D[:, np.newaxis, np.newaxis]
 
         return Input_D, Scale_D
 
@@ -278,7 +420,7 @@ class Dataloader:
         batch_D = self.flist_D[start:end]
 
         size_input = [end - start, self.nY, self.nX, self.nC]
-        size_mask = [end - start, self.nY, self.nX, int(self.nC / 2)]
+        size_mask = [end - start, 1 if self.compact_mask else self.nY, self.nX, int(self.nC / 2)]
 
         Input_F = np.empty(size_input, dtype=np.float32)
         Mask_F = np.empty(size_mask, dtype=np.float32)
@@ -286,40 +428,45 @@ class Dataloader:
         Input_D = np.empty(size_input, dtype=np.float32)
         Mask_D = np.empty(size_mask, dtype=np.float32)
 
-        for iB in range(len(batch_F)):
-            aInput_F = self.read_mat(batch_F[iB])  # concatenated real/imaginary image
-            aInput_D = self.read_mat(batch_D[iB])  # concatenated real/imaginary image
+        nB = len(batch_F)
+        aInput_F = np.stack([self.load_mat(f) for f in batch_F])  # concatenated real/imaginary images
+        k_orig_F = self.kspace_batch(batch_F, 'complex', aInput_F)
+        k_orig_D = self.kspace_batch(batch_D, 'complex')  # the downsampled domain only needs k-space
 
-            aMask_F = self.make_mask_X(aInput_F, self.R)
-            aMask_D = self.make_mask_X(aInput_D, self.R)
+        aMask_F = self.make_mask_lines(nB, self.nX, self.R)[:, np.newaxis, :, np.newaxis]  # (B,1,W,1) column masks
+        aMask_D = self.make_mask_lines(nB, self.nX, self.R)[:, np.newaxis, :, np.newaxis]
 
-            aMask_F = np.tile(aMask_F[:, :, np.newaxis], [1, 1, int(self.nC / 2)])
-            aMask_D = np.tile(aMask_D[:, :, np.newaxis], [1, 1, int(self.nC / 2)])
-
-            k_orig_F = np.fft.fftshift(fft2c(ri2complex(aInput_F)), axes=[0, 1])
-            k_down_F = k_orig_F * aMask_F
-            tmp = complex2ri(ifft2c(np.fft.ifftshift(k_down_F, axes=[0, 1])))
-
-            k_orig_D = np.fft.fftshift(fft2c(ri2complex(aInput_D)), axes=[0, 1])
-            k_down_D = k_orig_D * aMask_D
-            aInput_D = complex2ri(ifft2c(np.fft.ifftshift(k_down_D, axes=[0, 1])))
-
-            aScale_F = np.std(ri2ssos(tmp))
-            aInput_F = aInput_F / aScale_F
-            aScale_D = np.std(ri2ssos(aInput_D))
-            aInput_D = aInput_D / aScale_D
+        tmp = self.ifft_batch(k_orig_F * aMask_F)
+        aInput_D = self.ifft_batch(k_orig_D * aMask_D)
 
-            if self.phase == 'train' and self.augmentation:
-                aInput_F, aMask_F = self.augment_data(aInput_F, aMask_F)
-                aInput_D, aMask_D = self.augment_data(aInput_D, aMask_D)
+        # ri2ssos combines the channels (last axis), so it works on the whole BHWC stack
+        aScale_F = np.std(ri2ssos(tmp), axis=(1, 2))[:, np.newaxis, np.newaxis, np.newaxis]
+        Input_F[:] = aInput_F / aScale_F
+        aScale_D = np.std(ri2ssos(aInput_D), axis=(1, 2))[:, np.newaxis, np.newaxis, np.newaxis]
+        Input_D[:] = aInput_D / aScale_D
+        Mask_F[:] = aMask_F
+        Mask_D[:] = aMask_D
 
-            Input_F[iB, :, :, :] = aInput_F
-            Input_D[iB, :, :, :] = aInput_D
-            Mask_F[iB, :, :, :] = aMask_F
-            Mask_D[iB, :, :, :] = aMask_D
+        if self.phase == 'train' and self.augmentation:
+            for iB in range(nB):
+                Input_F[iB], Mask_F[iB] = self.augment_data(Input_F[iB], Mask_F[iB])
+                Input_D[iB], Mask_D[iB] = self.augment_data(Input_D[iB], Mask_D[iB])
 
         return Input_F, Mask_F, Input_D, Mask_D
 
+    @staticmethod
+    def ifft_batch(k_down):
+        """
+        Concatenated real/imaginary images of a batch of centered k-spaces, one ifft2c call for the whole batch
+        :param k_down: 4D (BHWC/2) complex numpy array
+        :return: 4D (BHWC) output numpy array
+        """
+        nB, nY, nX, nC = k_down.shape
+        k_down = np.fft.ifftshift(k_down, axes=[1, 2])
+        k_down = np.moveaxis(k_down, 0, 2).reshape(nY, nX, nB * nC)  # batch folded into channels
+        img = np.moveaxis(ifft2c(k_down).reshape(nY, nX, nB, nC), 2, 0)
+        return complex2ri(img)  # real/imaginary concatenated along the last (channel) axis
+
     def getBatch_complex_test(self, idx):
         """
         Make and return batch data (for complex image, inference)
@@ -334,13 +481,12 @@ class Dataloader:
         Scale_D = np.empty(size_input, dtype=np.float32)
 
         for iB in range(self.N):
-            aInput_D = self.read_mat(batch_D)  # concatenated real/imaginary image with motion artifact
+            k_orig_D = self.kspace(batch_D, 'complex')  # concatenated real/imaginary image with motion artifact
 
-            aMask_D = self.make_mask(aInput_D, self.R)
+            aMask_D = self.make_mask(k_orig_D, self.R, compact=True)
 
             aMask_D = np.tile(aMask_D[:, :, np.newaxis], [1, 1, int(self.nC / 2)])
 
-            k_orig_D = np.fft.fftshift(fft2c(ri2complex(aInput_D)), axes=[0, 1])
             k_down_D = k_orig_D * aMask_D
             aInput_D = complex2ri(ifft2c(np.fft.ifftshift(k_down_D, axes=[0, 1])))
 
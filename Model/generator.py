@@ -57,6 +57,7 @@ class Downsampling:
     def __init__(self, name):
         """
         Fourier transform -> subsampling -> inverse Fourier transform
+        The mask is either full (BHWC) or compact: (BH1C) rows or (B1WC) columns, broadcast by the multiply.
         :param name: string
         """
         self.name = name
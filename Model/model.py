@@ -61,8 +61,9 @@ class MR_motion_magnitude:
 
             self.real_F = tf.placeholder(tf.float32, [None, self.nY, self.nX, self.nC], name='real_F')
             self.real_D = tf.placeholder(tf.float32, [None, self.nY, self.nX, self.nC], name='real_D')
-            self.mask_F = tf.placeholder(tf.float32, [None, self.nY, self.nX, self.nC], name='mask_F')
-            self.mask_D = tf.placeholder(tf.float32, [None, self.nY, self.nX, self.nC], name='mask_D')
+            mask_nX = 1 if getattr(self.opt, 'compact_mask', False) else self.nX  # row masks broadcast along x
+            self.mask_F = tf.placeholder(tf.float32, [None, self.nY, mask_nX, self.nC], name='mask_F')
+            self.mask_D = tf.placeholder(tf.float32, [None, self.nY, mask_nX, self.nC], name='mask_D')
 
             self.fake_F = self.G_D2F(self.real_D)
             self.fake_D = self.G_F2D(self.real_F, self.mask_F)
@@ -198,6 +199,7 @@ class MR_motion_magnitude:
 
             epoch_sum = self.sess.run(self.epoch_sum, feed_dict)
             self.writer.add_summary(epoch_sum, epoch + 1)
+            tqdm.write('read cache: {hits} hits, {misses} misses, {entries} slices'.format(**dataloader.read_cache_stats()))
 
             if (epoch + 1) % self.save_epoch == 0:
                 self.saver.save(self.sess, join(self.ckpt_dir, 'model.ckpt'), global_step=epoch + 1)
@@ -332,8 +334,9 @@ class MR_motion_complex:
 
             self.real_F = tf.placeholder(tf.float32, [None, self.nY, self.nX, self.nC], name='real_F')
             self.real_D = tf.placeholder(tf.float32, [None, self.nY, self.nX, self.nC], name='real_D')
-            self.mask_F = tf.placeholder(tf.float32, [None, self.nY, self.nX, int(self.nC / 2)], name='mask_F')
-            self.mask_D = tf.placeholder(tf.float32, [None, self.nY, self.nX, int(self.nC / 2)], name='mask_D')
+            mask_nY = 1 if getattr(self.opt, 'compact_mask', False) else self.nY  # column masks broadcast along y
+            self.mask_F = tf.placeholder(tf.float32, [None, mask_nY, self.nX, int(self.nC / 2)], name='mask_F')
+            self.mask_D = tf.placeholder(tf.float32, [None, mask_nY, self.nX, int(self.nC / 2)], name='mask_D')
 
             self.fake_F = self.G_D2F(self.real_D)
             self.fake_D = self.G_F2D(self.real_F, self.mask_F)
@@ -470,6 +473,7 @@ class MR_motion_complex:
 
             epoch_sum = self.sess.run(self.epoch_sum, feed_dict)
             self.writer.add_summary(epoch_sum, epoch + 1)
+            tqdm.write('read cache: {hits} hits, {misses} misses, {entries} slices'.format(**dataloader.read_cache_stats()))
 
             if (epoch + 1) % self.save_epoch == 0:
                 self.saver.save(self.sess, join(self.ckpt_dir, 'model.ckpt'), global_step=epoch + 1)
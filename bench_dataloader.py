@@ -0,0 +1,82 @@
+"""
+Throughput of Dataloader.getBatch_magnitude (batched) against the former per-sample loop, in samples/s.
+
+python bench_dataloader.py --data_root /data/bootstrap --batch_size 8
+Without --data_root a temporary folder of random 520x520 Spec2D .mat files is used.
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from os import makedirs
+from os.path import join
+from types import SimpleNamespace
+
+import numpy as np
+from scipy import io as sio
+
+from Dataloader.dataloader import Dataloader
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_root', type=str, default='', help="folder with a train/ subfolder of .mat files")
+parser.add_argument('--num_files', type=int, default=32, help="files of the temporary dataset")
+parser.add_argument('--batch_size', type=int, default=8)
+parser.add_argument('--steps', type=int, default=20, help="timed batches per run")
+parser.add_argument('--nY', type=int, default=320)
+parser.add_argument('--nX', type=int, default=320)
+parser.add_argument('--R', type=int, default=3, help="downsampling rate")
+parser.add_argument('--read_cache_mb', type=int, default=0, help="read_mat cache of the batched run, 0 times decoding")
+parser.add_argument('--fft_workers', type=int, default=-1, help="threads of the batched FFTs, -1 uses all cores")
+opts = parser.parse_args()
+
+
+def loop_batch_magnitude(dataloader, start, end):
+    """
+    Reference: the per-sample batch assembly getBatch_magnitude replaced
+    """
+    end = min([end, dataloader.len])
+    size_input = [end - start, dataloader.nY, dataloader.nX, dataloader.nC]
+    Input_F = np.empty(size_input, dtype=np.float32)
+    Input_D = np.empty(size_input, dtype=np.float32)
+    for iB, (aFile_F, aFile_D) in enumerate(zip(dataloader.flist_F[start:end], dataloader.flist_D[start:end])):
+        aInput_F = dataloader.read_mat(aFile_F)
+        aInput_D = dataloader.read_mat(aFile_D)
+        aMask_F = dataloader.make_mask(aInput_F, dataloader.R)
+        aMask_D = dataloader.make_mask(aInput_D, dataloader.R)
+        tmp = np.abs(np.fft.ifft2(np.fft.ifftshift(np.fft.fftshift(np.fft.fft2(aInput_F)) * aMask_F)))
+        aInput_D = np.abs(np.fft.ifft2(np.fft.ifftshift(np.fft.fftshift(np.fft.fft2(aInput_D)) * aMask_D)))
+        Input_F[iB, :, :, 0] = aInput_F / np.std(tmp)
+        Input_D[iB, :, :, 0] = aInput_D / np.std(aInput_D)
+    return Input_F, Input_D
+
+
+def throughput(get_batch, dataloader):
+    get_batch(0, opts.batch_size)  # warm-up
+    nBatch = max(dataloader.len // opts.batch_size, 1)
+    start = time.perf_counter()
+    for step in range(opts.steps):
+        first = (step % nBatch) * opts.batch_size
+        get_batch(first, first + opts.batch_size)
+    return opts.steps * opts.batch_size / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    data_root = opts.data_root
+    if not data_root:
+        data_root = tempfile.mkdtemp()
+        makedirs(join(data_root, 'train'))
+        for i in range(opts.num_files):
+            sio.savemat(join(data_root, 'train', '%04d.mat' % i), {'Spec2D': np.random.rand(520, 520)})
+
+    try:
+        opt = SimpleNamespace(data_root=data_root, nY=opts.nY, nX=opts.nX, nC=1, R=opts.R, N=1,
+                              augmentation=False, fft_workers=opts.fft_workers,
+                              read_cache_mb=opts.read_cache_mb)
+        dataloader = Dataloader(opt, 'train')
+        loop = throughput(lambda start, end: loop_batch_magnitude(dataloader, start, end), dataloader)
+        batched = throughput(dataloader.getBatch_magnitude, dataloader)
+        print('per-sample loop: %.1f samples/s' % loop)
+        print('batched:         %.1f samples/s (x%.2f)' % (batched, batched / loop))
+    finally:
+        if not opts.data_root:
+            shutil.rmtree(data_root)
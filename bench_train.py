@@ -0,0 +1,51 @@
+"""
+Training steps/s of UNIT_Trainer (dis_update + gen_update) on CPU, eager against torch.compile.
+
+python bench_train.py --config configs/unit_noise2clear-bn.yaml --batch_size 4 --size 128
+"""
+import argparse
+import time
+
+import torch
+
+from trainer import UNIT_Trainer
+from utils import get_config
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', type=str, default='configs/unit_noise2clear-bn.yaml', help='Path to the config file.')
+parser.add_argument('--batch_size', type=int, default=4)
+parser.add_argument('--size', type=int, default=128, help="height and width of the random input patches")
+parser.add_argument('--warmup', type=int, default=3, help="untimed steps, they include the compilation")
+parser.add_argument('--steps', type=int, default=10, help="timed steps per mode")
+parser.add_argument('--threads', type=int, default=0, help="torch CPU threads, 0 keeps the default")
+opts = parser.parse_args()
+
+
+def steps_per_second(config, x_a, x_b):
+    torch.manual_seed(0)
+    trainer = UNIT_Trainer(config)
+    losses_gen = [[] for _ in range(8)]
+    losses_dis = [[], []]
+    for _ in range(opts.warmup):
+        trainer.dis_update(x_a, x_b, config, *losses_dis)
+        trainer.gen_update(x_a, x_b, config, *losses_gen)
+    start = time.perf_counter()
+    for _ in range(opts.steps):
+        trainer.dis_update(x_a, x_b, config, *losses_dis)
+        trainer.gen_update(x_a, x_b, config, *losses_gen)
+    return opts.steps / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    if opts.threads > 0:
+        torch.set_num_threads(opts.threads)
+    config = get_config(opts.config)
+    x_a = torch.rand(opts.batch_size, config['input_dim_a'], opts.size, opts.size)
+    x_b = torch.rand(opts.batch_size, config['input_dim_b'], opts.size, opts.size)
+
+    config['compile'] = False
+    eager = steps_per_second(config, x_a, x_b)
+    print('eager:    %.3f steps/s' % eager)
+    config['compile'] = True
+    compiled = steps_per_second(config, x_a, x_b)
+    print('compiled: %.3f steps/s (x%.2f)' % (compiled, compiled / eager))
@@ -95,7 +95,12 @@ import os.path
 import numpy as np
 import random
 import glob
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import scipy.io as sio
+from preprocess import minmax_normalize
 cuda = True if torch.cuda.is_available() else False
 Tensor = torch.cuda.FloatTensor if cuda else torch.Tensor
 
@@ -160,14 +165,8 @@ class myImageFolder(data.Dataset):
         name = name_tem.split('.')[0]
         data = mat[name]
         data = np.float32(data)
-        out = np.zeros(data.shape, dtype=np.float32)
-        for i in range(data.shape[0]):
-            data1 = data[i,:,:]
-            tem1 = np.zeros(data1.shape, dtype=np.float32)
-            cv2.normalize(data1, tem1, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-            out[i, :, :] = tem1[:,:]
         self.root = root
-        self.imgs = out
+        self.imgs = minmax_normalize(data, inplace=True)
 
     def __getitem__(self, index):
         img = self.imgs[index]
@@ -186,80 +185,365 @@ class myImageFolder(data.Dataset):
         return len(self.imgs)
 
 
-class mymotionImageFolder(data.Dataset):
-
-    def __init__(self, root):
-        seqs_dirs = sorted(glob.glob(os.path.join(root, '*')))
-        sequences_motion = []
-        for seq_dir in seqs_dirs:
-            mat = sio.loadmat(seq_dir)
+def load_motion_volume(path):
+    """
+    Load the `dicomV1` volume of a .mat file and min-max normalize every slice to [0, 1].
+    :param path: path of the .mat file
+    :return: 3D (SHW) float32 numpy array
+    """
+    mat = sio.loadmat(path)
+    data = np.float32(mat['dicomV1'])
+    # data = data[:, 1, :, :]
+    # data = np.transpose(data, [2, 0, 1])
+    # data = data[:400, :, :]
+    return minmax_normalize(data, inplace=True)
 
-            data = np.float32(mat['dicomV1'])
-            # data = data[:, 1, :, :]
-            # data = np.transpose(data, [2, 0, 1])
-            # data = data[:400, :, :]
 
-            data = np.float32(data)
-            for i in range(0,data.shape[0]):
-                tem = data[i,:,:]
-                tem1 = np.zeros(tem.shape, dtype=np.float32)
-                cv2.normalize(tem, tem1, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-                sequences_motion.append(tem1)
+def iter_volumes(paths, loader=load_motion_volume, workers=0, pool='thread'):
+    """
+    Load volumes with a pool of workers, yielding them in the order of `paths`.
+    At most 2 * workers volumes are in flight, so memory stays bounded for long lists.
+    :param paths: list of .mat files
+    :param loader: function returning the normalized (S,H,W) volume of a file
+    :param workers: number of pool workers, <= 1 loads serially
+    :param pool: 'thread' (loadmat decompression and numpy release the GIL) or 'process'
+    """
+    if workers <= 1:
+        for p in paths:
+            yield loader(p)
+        return
+    if pool == 'thread':
+        executor = ThreadPoolExecutor(workers)
+    elif pool == 'process':
+        executor = ProcessPoolExecutor(workers)
+    else:
+        assert 0, "Unsupported ingestion pool: {}".format(pool)
+    with executor:
+        futures = []
+        for p in paths:
+            futures.append(executor.submit(loader, p))
+            if len(futures) >= 2 * workers:
+                yield futures.pop(0).result()
+        for f in futures:
+            yield f.result()
+
+
+def source_fingerprint(path):
+    """
+    Cheap fingerprint of a source file, changes whenever the file is rewritten.
+    :param path: path of the file
+    :return: tuple (absolute path, mtime in ns, size in bytes)
+    """
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
 
-        self.motion = sequences_motion
 
+class VolumeCache(object):
+    """
+    Persistent cache of normalized volumes, one .npy file per volume in `cache_dir`.
+    Entries are keyed by the source fingerprint and the preprocessing parameters, so a
+    volume is only re-read and re-normalized when its file or the preprocessing changes.
+    When `max_bytes` > 0 the least recently used entries are evicted to keep the cache bounded.
+    """
+    def __init__(self, cache_dir, max_bytes=0, loader=load_motion_volume, params=('dicomV1', 'minmax', 0, 1)):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.loader = loader
+        self.params = params
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, path):
+        return hashlib.sha1(repr((source_fingerprint(path), self.params)).encode('utf-8')).hexdigest()
+
+    def __call__(self, path):
+        entry = os.path.join(self.cache_dir, self.key(path) + '.npy')
+        if os.path.exists(entry):
+            try:
+                volume = np.load(entry)
+                os.utime(entry, None)  # mark as recently used
+                self.hits += 1
+                return volume
+            except (IOError, OSError, ValueError):
+                pass  # truncated or concurrently evicted entry, rebuild it
+        self.misses += 1
+        volume = np.ascontiguousarray(self.loader(path), dtype=np.float32)
+        tmp = entry + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())  # unique per ingestion thread
+        with open(tmp, 'wb') as f:
+            np.save(f, volume)
+        os.replace(tmp, entry)
+        self.evict(keep=entry)
+        return volume
+
+    def evict(self, keep=None):
+        # may run concurrently in several ingestion threads/processes, a vanished entry counts as evicted
+        if self.max_bytes <= 0:
+            return
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.npy'):
+                p = os.path.join(self.cache_dir, fname)
+                try:
+                    st = os.stat(p)
+                except FileNotFoundError:
+                    continue  # evicted by another ingestion worker meanwhile
+                entries.append((st.st_mtime, st.st_size, p))
+        total = sum(e[1] for e in entries)
+        for _, size, p in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass  # already evicted by another worker
+            total -= size
+
+
+class SliceStore(object):
+    """
+    Read-only view of a slice store: one contiguous float32 file (<path>.bin) holding every
+    slice back to back, and an index (<path>.idx.npz) with the (offset, height, width) of each slice.
+    The file is memory-mapped lazily, so DataLoader workers share the page cache instead of
+    each holding a private copy of the whole dataset.
+    """
+    def __init__(self, path):
+        self.path = path
+        idx = np.load(path + '.idx.npz')
+        self.index = idx['index']
+        self.sources = [tuple(s) for s in idx['sources'].tolist()]
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.path + '.bin', dtype=np.float32, mode='r')
+        return self._data
 
     def __getitem__(self, index):
-        motion = self.motion[index]
-        height = 128
-        width = 128
-        tem_height = random.randint(10,motion.shape[0]-height-10)
-        tem_width = random.randint(10,motion.shape[1]-width-10)
-        patch = motion[tem_height:tem_height+128,tem_width:tem_width+128]
+        offset, height, width = self.index[index]
+        return self.data[offset:offset + height * width].reshape(height, width)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # never pickle the mapping itself, workers re-open it on first access
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+
+def build_slice_store(paths, path, loader=load_motion_volume, workers=0, pool='thread'):
+    """
+    Write the normalized slices of all volumes into a slice store.
+    :param paths: list of .mat files, slices are stored in this order
+    :param path: store path prefix, <path>.bin and <path>.idx.npz are created
+    :param loader: function returning the normalized (S,H,W) volume of a file
+    :param workers: number of volumes loaded in parallel, see iter_volumes
+    :param pool: 'thread' or 'process'
+    :return: SliceStore
+    """
+    index = []
+    sources = []
+    offset = 0
+    with open(path + '.bin.tmp', 'wb') as f:
+        for p, volume in zip(paths, iter_volumes(paths, loader, workers, pool)):
+            volume = np.ascontiguousarray(volume, dtype=np.float32)
+            for i in range(volume.shape[0]):
+                index.append((offset, volume.shape[1], volume.shape[2]))
+                offset += volume.shape[1] * volume.shape[2]
+            f.write(volume.tobytes())
+            fp = source_fingerprint(p)
+            sources.append((fp[0], str(fp[1]), str(fp[2])))
+    with open(path + '.idx.npz.tmp', 'wb') as f:
+        np.savez(f, index=np.array(index, dtype=np.int64).reshape(-1, 3), sources=np.array(sources))
+    os.replace(path + '.bin.tmp', path + '.bin')
+    os.replace(path + '.idx.npz.tmp', path + '.idx.npz')
+    return SliceStore(path)
+
+
+def open_slice_store(root, store_dir, loader=load_motion_volume, workers=0, pool='thread'):
+    """
+    Open the slice store of a folder of volumes, (re)building it when it is missing or
+    when the set of source files or any of their fingerprints changed.
+    :param root: folder of .mat volumes
+    :param store_dir: directory holding the stores, one store per folder name
+    :param loader: function returning the normalized (S,H,W) volume of a file
+    :param workers: number of volumes loaded in parallel when (re)building
+    :param pool: 'thread' or 'process'
+    :return: SliceStore
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    paths = sorted(glob.glob(os.path.join(root, '*')))
+    path = os.path.join(store_dir, os.path.basename(os.path.normpath(root)))
+    if os.path.exists(path + '.bin') and os.path.exists(path + '.idx.npz'):
+        store = SliceStore(path)
+        fps = [source_fingerprint(p) for p in paths]
+        if store.sources == [(fp[0], str(fp[1]), str(fp[2])) for fp in fps]:
+            return store
+    print("Building slice store: {}".format(path))
+    return build_slice_store(paths, path, loader, workers, pool)
+
+
+def random_patch(img, height=128, width=128):
+    """
+    Random (1,height,width) crop of a 2D slice, keeping a 10 pixel margin to the border.
+    """
+    tem_height = random.randint(10, img.shape[0] - height - 10)
+    tem_width = random.randint(10, img.shape[1] - width - 10)
+    patch = np.array(img[tem_height:tem_height + height, tem_width:tem_width + width])
+
+    patch = np.expand_dims(patch, axis=0)
+    # input = Variable(torch.from_numpy(patch).type(Tensor),dtype = torch.float64)
+    input = torch.from_numpy(patch)
+    return input
 
-        patch = np.expand_dims(patch, axis=0)
-        # input = Variable(torch.from_numpy(patch).type(Tensor),dtype = torch.float64)
-        input = torch.from_numpy(patch)
-        return input
+
+class mymotionImageFolder(data.Dataset):
+
+    def __init__(self, root, store_dir=None, cache=None, workers=0, pool='thread'):
+        # cache: optional VolumeCache, volumes are otherwise loaded and normalized from scratch
+        # workers/pool: parallel volume loading, see iter_volumes
+        loader = cache if cache is not None else load_motion_volume
+        if store_dir:
+            # memory-mapped slices, shared by all DataLoader workers
+            self.motion = open_slice_store(root, store_dir, loader, workers, pool)
+        else:
+            seqs_dirs = sorted(glob.glob(os.path.join(root, '*')))
+            sequences_motion = []
+            for volume in iter_volumes(seqs_dirs, loader, workers, pool):
+                sequences_motion.extend(volume)
+            self.motion = sequences_motion
+
+    def __getitem__(self, index):
+        return random_patch(self.motion[index])
 
     def __len__(self):
         return len(self.motion)
 
-class mymotionImageFolder2(data.Dataset):
+class mymotionImageFolder2(mymotionImageFolder):
+    pass
+
+
+class LazyMotionImageFolder(data.Dataset):
+    """
+    Same samples as mymotionImageFolder, but volumes are only read when one of their slices
+    is requested. The (volume, slice) index is built from the .mat headers, and each
+    DataLoader worker keeps at most `max_volumes` decoded volumes in an LRU cache.
+    The cache only pays off when slices of a volume are drawn close together, shuffle with
+    VolumeGroupedSampler rather than uniformly over the whole index.
+    """
+    def __init__(self, root, max_volumes=4, cache=None):
+        self.paths = sorted(glob.glob(os.path.join(root, '*')))
+        self.loader = cache if cache is not None else load_motion_volume
+        self.max_volumes = max_volumes
+        index = []
+        self.offsets = [0]  # items of volume v are index[offsets[v]:offsets[v + 1]]
+        for v, path in enumerate(self.paths):
+            shapes = dict((name, shape) for name, shape, _ in sio.whosmat(path))
+            index.extend((v, i) for i in range(shapes['dicomV1'][0]))
+            self.offsets.append(len(index))
+        self.index = index
+        self.volumes = OrderedDict()
+
+    def volume(self, v):
+        if v in self.volumes:
+            self.volumes.move_to_end(v)
+            return self.volumes[v]
+        volume = self.loader(self.paths[v])
+        self.volumes[v] = volume
+        if len(self.volumes) > self.max_volumes:
+            self.volumes.popitem(last=False)
+        return volume
+
+    def __getitem__(self, index):
+        v, i = self.index[index]
+        return random_patch(self.volume(v)[i])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # workers start with an empty cache
+        state = self.__dict__.copy()
+        state['volumes'] = OrderedDict()
+        return state
 
-    def __init__(self, root):
-        seqs_dirs = sorted(glob.glob(os.path.join(root, '*')))
-        sequences_motion = []
-        for seq_dir in seqs_dirs:
-            mat = sio.loadmat(seq_dir)
 
-            data = np.float32(mat['dicomV1'])
-            # data = data[:, 1, :, :]
-            # data = np.transpose(data, [2, 0, 1])
-            # data = data[:400,:,:]
+class VolumeGroupedSampler(data.Sampler):
+    """
+    Shuffled order for LazyMotionImageFolder that keeps its volume cache useful: the volume order
+    is shuffled, then the slices are shuffled only within windows of `window` consecutive volumes,
+    so each volume is decoded once per window instead of about once per slice.
+    """
+    def __init__(self, dataset, window, shuffle=True):
+        self.offsets = dataset.offsets
+        self.window = max(window, 1)
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        nV = len(self.offsets) - 1
+        volumes = torch.randperm(nV).tolist() if self.shuffle else list(range(nV))
+        order = []
+        for start in range(0, nV, self.window):
+            items = torch.cat([torch.arange(self.offsets[v], self.offsets[v + 1])
+                               for v in volumes[start:start + self.window]])
+            order.extend((items[torch.randperm(len(items))] if self.shuffle else items).tolist())
+        return iter(order)
 
-            data = np.float32(data)
-            for i in range(0,data.shape[0]):
-                tem = data[i,:,:]
-                tem1 = np.zeros(tem.shape, dtype=np.float32)
-                cv2.normalize(tem, tem1, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-                sequences_motion.append(tem1)
+    def __len__(self):
+        return self.offsets[-1]
 
-        self.motion = sequences_motion
 
+class PairedDataset(data.Dataset):
+    """
+    Joint view of the motion (A) and gt (B) datasets, each item is an (A, B) pair so that one
+    worker pool, one collate and one transfer serve both domains.
+    Items are indexed by (index_a, index_b) tuples, as drawn by PairedRandomSampler.
+    """
+    def __init__(self, dataset_a, dataset_b):
+        self.dataset_a = dataset_a
+        self.dataset_b = dataset_b
 
     def __getitem__(self, index):
-        motion = self.motion[index]
-        height = 128
-        width = 128
-        tem_height = random.randint(10,motion.shape[0]-height-10)
-        tem_width = random.randint(10,motion.shape[1]-width-10)
-        patch = motion[tem_height:tem_height+128,tem_width:tem_width+128]
+        index_a, index_b = index
+        return self.dataset_a[index_a], self.dataset_b[index_b]
 
-        patch = np.expand_dims(patch, axis=0)
-        # input = Variable(torch.from_numpy(patch).type(Tensor),dtype = torch.float64)
-        input = torch.from_numpy(patch)
-        return input
+    def __len__(self):
+        return max(len(self.dataset_a), len(self.dataset_b))
+
+
+class PairedRandomSampler(data.Sampler):
+    """
+    Draws (index_a, index_b) pairs with an independent order per domain. An epoch covers the
+    larger domain once; the smaller one is reshuffled whenever it runs out.
+    A domain can take its order from its own sampler (e.g. VolumeGroupedSampler for lazy datasets).
+    """
+    def __init__(self, len_a, len_b, shuffle=True, sampler_a=None, sampler_b=None):
+        assert len_a > 0 and len_b > 0, "PairedRandomSampler: empty domain (len_a={}, len_b={})".format(len_a, len_b)
+        self.len_a = len_a
+        self.len_b = len_b
+        self.shuffle = shuffle
+        self.sampler_a = sampler_a
+        self.sampler_b = sampler_b
+
+    def order(self, size, n, sampler=None):
+        orders = []
+        while sum(len(o) for o in orders) < n:
+            if sampler is not None:
+                orders.append(torch.tensor(list(sampler), dtype=torch.long))
+            else:
+                orders.append(torch.randperm(size) if self.shuffle else torch.arange(size))
+        return torch.cat(orders)[:n].tolist()
+
+    def __iter__(self):
+        n = len(self)
+        return iter(zip(self.order(self.len_a, n, self.sampler_a), self.order(self.len_b, n, self.sampler_b)))
 
     def __len__(self):
-        return len(self.motion)
\ No newline at end of file
+        return max(self.len_a, self.len_b)
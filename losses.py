@@ -0,0 +1,19 @@
+"""
+Losses of the training objective that only need torch, importable without the network stack.
+"""
+import torch
+
+
+def projection_loss(input, target):
+    """
+    L1 distance of the max-normalized column profiles (sums over rows) of 1-channel BCHW images,
+    summed over the batch in one pass.
+    :param input: 4D (B1HW) tensor
+    :param target: 4D (B1HW) tensor of the same shape
+    :return: scalar tensor
+    """
+    sum_ori = torch.sum(input, dim=2)
+    sum_now = torch.sum(target, dim=2)
+    sum_ori = sum_ori / torch.amax(sum_ori, dim=(1, 2), keepdim=True)
+    sum_now = sum_now / torch.amax(sum_now, dim=(1, 2), keepdim=True)
+    return torch.sum(torch.abs(sum_ori - sum_now))
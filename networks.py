@@ -442,17 +442,73 @@ class LinearBlock(nn.Module):
 
 
 
+def fold_rgb_conv(conv):
+    """
+    1-channel copy of an RGB input convolution, its weights summed over the input channels.
+    conv_1(x) == conv(cat((x, x, x), 1)) for a 1-channel x, at a third of the input memory and FLOPs.
+    :param conv: nn.Conv2d with 3 input channels
+    :return: nn.Conv2d with 1 input channel
+    """
+    folded = nn.Conv2d(1, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation,
+                       bias=conv.bias is not None)
+    with torch.no_grad():
+        folded.weight.copy_(conv.weight.sum(dim=1, keepdim=True))
+        if conv.bias is not None:
+            folded.bias.copy_(conv.bias)
+    return folded
+
 class vgg_19(nn.Module):
     def __init__(self):
         super(vgg_19, self).__init__()
         vgg_model = torchvision.models.vgg19(pretrained=True)
         self.feature_ext = nn.Sequential(*list(vgg_model.features.children())[:20])
+        self.feature_ext[0] = fold_rgb_conv(self.feature_ext[0])  # takes the 1-channel images directly
     def forward(self, x):
-        if x.size(1) == 1:
-            x = torch.cat((x, x, x), 1)
         out = self.feature_ext(x)
         return out
 
+class VGGFeatures(object):
+    """
+    Feature engine of the perceptual loss: the predictions of a step go through the VGG in one concatenated pass,
+    the features of targets are memoized by tensor identity (and version), so a batch is encoded once per step.
+    :param vgg: feature extractor
+    :param norm: optional module applied to every feature map (e.g. InstanceNorm2d), targets are cached normalized
+    :param max_targets: number of target tensors whose features are kept
+    """
+    def __init__(self, vgg, norm=None, max_targets=4):
+        self.vgg = vgg
+        self.norm = norm
+        self.max_targets = max_targets
+        self.targets = []  # (tensor, version, features), most recent last
+        self.hits = 0
+        self.misses = 0
+
+    def features(self, x):
+        out = self.vgg(x)
+        return self.norm(out) if self.norm is not None else out
+
+    def target(self, x):
+        if x.requires_grad:  # gradients must flow through the target features, nothing to cache
+            return self.features(x)
+        for entry in self.targets:
+            if entry[0] is x and entry[1] == x._version:
+                self.hits += 1
+                return entry[2]
+        self.misses += 1
+        with torch.no_grad():
+            out = self.features(x)
+        self.targets = (self.targets + [(x, x._version, out)])[-self.max_targets:]
+        return out
+
+    def distances(self, pairs):
+        """
+        Mean squared feature distance of each (prediction, target) pair, all predictions in one VGG pass
+        :param pairs: list of (prediction, target) BCHW tensors, predictions of the same shape
+        :return: list of scalar tensors
+        """
+        preds = self.features(torch.cat([pred for pred, _ in pairs], 0)).chunk(len(pairs), 0)
+        return [torch.mean((pred - self.target(target)) ** 2) for pred, (_, target) in zip(preds, pairs)]
+
 ##################################################################################
 # Normalization layers
 ##################################################################################
@@ -500,6 +556,13 @@ class LayerNorm(nn.Module):
             self.beta = nn.Parameter(torch.zeros(num_features))
 
     def forward(self, x):
+        if torch.is_autocast_enabled(x.device.type):
+            # statistics and normalization in fp32 under autocast, the input dtype is kept otherwise
+            with torch.autocast(x.device.type, enabled=False):
+                return self.normalize(x.float())
+        return self.normalize(x)
+
+    def normalize(self, x):
         shape = [-1] + [1] * (x.dim() - 1)
         # if x.size(0) == 1:
         #     # These two lines run much faster in pytorch 0.4 than the two lines listed below.
@@ -522,8 +585,9 @@ class LayerNorm(nn.Module):
 # Mask Generator
 ##################################################################################
 class GenMask(nn.Module):
-    def __init__(self, dim, output_dim=4, res_norm='adain', activ='relu', pad_type='zero'):
+    def __init__(self, dim, output_dim=4, res_norm='adain', activ='relu', pad_type='zero', straight_through=False):
         super(GenMask, self).__init__()
+        self.straight_through = straight_through  # pass gradients through the threshold to train the mask
 
         self.model = []
         # AdaIN residual blocks
@@ -567,67 +631,120 @@ class GenMask(nn.Module):
     # 1: x>0.5 and (4/9,5/9)
     def forward(self, x):
         x = self.model(x)
-        mask = torch.zeros_like(x)
-        x = x.mean(3).view(x.shape[0], x.shape[1], x.shape[2], 1)
-
-        # normolize
-        for i in range(x.shape[0]):
-            for j in range(x.shape[1]):
-                x_min = torch.min(x[i,j,:,:])
-                x_max = torch.max(x[i,j,:,:])
-                x[i,j,:,:] = (x[i,j,:,:] - x_min) / (x_max - x_min)
-
-        start = x.shape[2] * 4 // 9
-        end = x.shape[2] * 5 // 9
-        for i in range(x.shape[0]):
-            for j in range(x.shape[1]):
-                for k in range(x.shape[2]):
-                    if x[i,j,k,0]>0.5 or start<k<end:
-                        mask[i,j,k,:] = 1
-
-        # make mid 1/9 lines 1
-        # mask[:, :, start:end, :] = 1
+        b, c, h, w = x.shape
+        x = x.mean(3, keepdim=True)
+
+        # normolize each channel to [0, 1], all samples at once
+        x_min = x.amin(dim=(2, 3), keepdim=True)
+        x_max = x.amax(dim=(2, 3), keepdim=True)
+        x = (x - x_min) / (x_max - x_min)
+
+        # keep the rows above 0.5 and make mid 1/9 lines 1
+        start = h * 4 // 9
+        end = h * 5 // 9
+        rows = torch.arange(h, device=x.device).view(1, 1, h, 1)
+        band = (rows > start) & (rows < end)
+        mask = ((x > 0.5) | band).to(x.dtype)
+        if self.straight_through:
+            # forward value is the binary mask, gradients flow to the normalized scores outside the band
+            mask = mask + torch.where(band, torch.zeros_like(x), x - x.detach())
         # mask = torch.repeat_interleave(x, 128, dim=3)
-        return mask.to(torch.complex64)
+        return mask.expand(b, c, h, w).to(torch.complex64)
 
-def make_mask(inp, R, gpuid):
+def make_mask(inp, R, gpuid, generator=None, compact=False):
     """
-    Make subsampling mask (1D Cartesian trajectory, Gaussian random sampling)
-    :param inp: 3D (HWC) output numpy array
+    Make subsampling masks (1D Cartesian trajectory, Gaussian random sampling), one per sample and channel.
+    All row indices of the batch are drawn in one call on the device of `inp`.
+    :param inp: 4D (BCHW) tensor, only its shape and device are used
     :param R: integer, downsampling rate
-    :return: 3D (HWC) output numpy array
+    :param gpuid: kept for call compatibility, the masks are created on inp's device
+    :param generator: optional torch.Generator on that device, for reproducible masks
+    :param compact: return the (BCH1) float32 row mask, which broadcasts along the readout axis
+    :return: 4D (BCHW) complex64 tensor, or (BCH1) float32 tensor if compact
     """
-    nY = inp.shape[2]
-    nX = inp.shape[3]
-    nC = inp.shape[1]
-    nB = inp.shape[0]
-    mask = np.zeros((nY, nX), dtype=np.complex64)
-    masks = np.zeros(inp.shape, dtype=np.complex64)
-    # masks = np.ones(inp.shape, dtype=np.complex64)
+    nB, nC, nY, nX = inp.shape
+    rows = mask_rows(nB * nC, nY, R, inp.device, generator)
+    if compact:
+        return rows.view(nB, nC, nY, 1).to(torch.float32)
+    masks = rows.view(nB, nC, nY, 1).expand(nB, nC, nY, nX).to(torch.complex64)
 
-    for i in range(nB):
-        for j in range(nC):
-            nACS = round(nY / (R ** 2))
-            ACS_s = round((nY - nACS) / 2)
-            ACS_e = ACS_s + nACS
-            mask[ACS_s:ACS_e, :] = 1
-
-            nSamples = int(nY / R)
-            r = np.floor(np.random.normal(nY / 2, 70, nSamples))
-            r = np.clip(r.astype(int), 0, nY - 1)
-            mask[r.tolist(), :] = 1
-            masks[i, j, :, :] = mask
+    return masks
 
+def mask_rows(n, nY, R, device, generator=None, sigma=70, nACS=None):
+    """
+    Draw n Gaussian random Cartesian row masks in one call.
+    :param n: number of masks
+    :param nY: number of k-space rows
+    :param R: integer, downsampling rate
+    :param device: torch device of the masks
+    :param generator: optional torch.Generator on that device
+    :param sigma: standard deviation of the row distribution around the k-space center
+    :param nACS: number of fully sampled center rows, nY / R^2 by default
+    :return: 2D (n, nY) bool tensor
+    """
+    if nACS is None:
+        nACS = round(nY / (R ** 2))
+    ACS_s = round((nY - nACS) / 2)
+    ACS_e = ACS_s + nACS
 
+    nSamples = int(nY / R)
+    r = torch.randn((n, nSamples), generator=generator, device=device) * sigma + nY / 2
+    r = torch.clamp(torch.floor(r), 0, nY - 1).long()
 
-    masks = torch.from_numpy(masks)
+    rows = torch.zeros((n, nY), dtype=torch.bool, device=device)
+    rows[:, ACS_s:ACS_e] = True
+    rows.scatter_(1, r, True)
+    return rows
 
-    return masks.to(device=gpuid)
+class MaskBank(object):
+    """
+    Pool of `size` row masks for one (nY, R, sigma, nACS) setting, drawn in bulk from `seed` and kept
+    on the device as an (size, nY) bool table. Masks are then picked by index: sample() draws random
+    indices from the bank's own seeded generator, take() returns fixed entries, e.g. for evaluation
+    with the same masks across checkpoints.
+    """
+    def __init__(self, nY, R, size=4096, sigma=70, nACS=None, seed=0, device='cpu'):
+        self.nY = nY
+        self.device = torch.device(device)
+        generator = torch.Generator(device=self.device)
+        generator.manual_seed(seed)
+        self.rows = mask_rows(size, nY, R, self.device, generator, sigma, nACS)
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed + 1)
+
+    def __len__(self):
+        return self.rows.shape[0]
+
+    def sample(self, nB, nC=1):
+        # random (BCH1) float32 row masks
+        index = torch.randint(len(self), (nB * nC,), generator=self.generator, device=self.device)
+        return self.take(index, nB, nC)
+
+    def take(self, index, nB=None, nC=1):
+        # masks at `index` (int tensor or list), as (len, 1, H, 1) or (nB, nC, H, 1) float32 row masks
+        index = torch.as_tensor(index, device=self.device).view(-1)
+        if nB is None:
+            nB = index.numel() // nC
+        return self.rows[index].view(nB, nC, self.nY, 1).to(torch.float32)
+
+def broadcast_mask(mask):
+    """
+    Masks are full (..., H, W) arrays or compact row masks: (..., H, 1) or a 1D (H,) vector of
+    selected k-space rows. Compact masks are viewed so that they broadcast along the readout axis.
+    """
+    if mask.dim() == 1:
+        mask = mask.view(-1, 1)
+    return mask
 
 # downsampling
 def downsampling(img, mask):
+    if torch.is_autocast_enabled(img.device.type):
+        img = img.float()  # k-space stays in fp32 under autocast
+    mask = broadcast_mask(mask)
     h = img.shape[2]
     w = img.shape[3]
+    if mask.shape[-1] == 1 and w % 2 == 0:
+        return downsampling_rows(img, mask)
     k_full = fft.fftn(img, dim=(2,3))
     k_full = torch.roll(k_full, (h//2, w//2), dims=(2,3))   # make zero frequency center
     k_down = torch.multiply(k_full, mask)
@@ -636,6 +753,36 @@ def downsampling(img, mask):
 
     return img_down.to(torch.float32)
 
+# downsampling with a row mask (..., H, 1)
+# The mask is constant along the readout axis, so the FFT/IFFT pair along x cancels (for even W the
+# two rolls along x add up to a full period) and only the phase-encode axis needs transforming.
+# roll(roll(k, s) * m, s) == roll(k, 2s) * roll(m, s), both rolls become index arithmetic on H.
+def downsampling_rows(img, mask):
+    h = img.shape[2]
+    s = h // 2
+    idx = torch.arange(h, device=img.device)
+    k_full = fft.fft(img, dim=2)
+    if 2 * s != h:
+        k_full = k_full.index_select(2, (idx - 2 * s) % h)
+    k_down = torch.multiply(k_full, mask.index_select(mask.dim() - 2, (idx - s) % h))
+    img_down = fft.ifft(k_down, dim=2)
+
+    return img_down.to(torch.float32)
+
+# fused downsampling of several same-shape tensors with one mask
+def downsampling_multi(imgs, mask):
+    """
+    One batched FFT/IFFT over the concatenation of `imgs` instead of one pair per tensor.
+    :param imgs: list of 4D (BCHW) tensors of the same shape
+    :param mask: mask for a single tensor, as accepted by downsampling
+    :return: tuple of downsampled tensors (views of one result), in the order of `imgs`
+    """
+    n = len(imgs)
+    mask = broadcast_mask(mask)
+    if mask.dim() == 4 and mask.shape[0] > 1:
+        mask = mask.repeat(n, 1, 1, 1)  # per-sample masks follow the concatenated batch
+    return downsampling(torch.cat(imgs, 0), mask).chunk(n, 0)
+
 # fft
 def img2k(img):
     h = img.shape[2]
@@ -645,10 +792,12 @@ def img2k(img):
 
     return k_full
 
-# ifft
-def k2img(k_down):
+# ifft, optionally masking the centered k-space first
+def k2img(k_down, mask=None):
     h = k_down.shape[2]
     w = k_down.shape[3]
+    if mask is not None:
+        k_down = torch.multiply(k_down, broadcast_mask(mask))
     k_down = torch.roll(k_down, (h // 2, w // 2), dims=(2, 3))
     img_down = fft.ifftn(k_down, dim=(2, 3))
 
@@ -0,0 +1,50 @@
+"""
+Preprocessing shared by the training datasets and inference.
+"""
+import numpy as np
+import torch
+
+
+def minmax_normalize(volume, inplace=False, device=None, alpha=0., beta=1.):
+    """
+    Min-max normalize every slice of a volume to [alpha, beta] in a single vectorized pass,
+    same result as calling cv2.normalize(..., NORM_MINMAX) on each slice (constant slices map to alpha).
+    :param volume: 3D (SHW) numpy array or torch tensor, a 2D (HW) slice is treated as one slice
+    :param inplace: normalize into `volume` itself, it must then be a float32 array/tensor
+                    (a numpy volume with `device` is always copied to a new tensor)
+    :param device: if given, the volume is moved to this torch device and normalized there
+    :param alpha: lower bound of the output range
+    :param beta: upper bound of the output range
+    :return: normalized float32 volume, numpy array unless `volume` is a tensor or `device` is given
+    """
+    if device is not None and not torch.is_tensor(volume):
+        # torch.tensor always copies, so the caller's array is never touched, even on the CPU
+        volume = torch.tensor(np.asarray(volume), dtype=torch.float32, device=device)
+        inplace = True
+    if torch.is_tensor(volume):
+        volume = volume.to(device=device, dtype=torch.float32) if device is not None else volume.float()
+        flat = volume.reshape(-1, volume.shape[-2] * volume.shape[-1])
+        vmin = flat.min(dim=1)[0].reshape(-1, 1, 1)
+        vmax = flat.max(dim=1)[0].reshape(-1, 1, 1)
+        rng = vmax - vmin
+        scale = torch.where(rng > 0, (beta - alpha) / rng, torch.zeros_like(rng))
+        out = volume if inplace else volume.clone()
+        out = out.view(-1, volume.shape[-2], volume.shape[-1])
+        out.sub_(vmin).mul_(scale).add_(alpha)
+        return out.view(volume.shape)
+
+    if inplace:
+        assert volume.dtype == np.float32, "in-place normalization needs a float32 array"
+        out = volume
+    else:
+        out = np.array(volume, dtype=np.float32)
+    out3 = out.reshape(-1, out.shape[-2], out.shape[-1])
+    vmin = out3.min(axis=(1, 2), keepdims=True)
+    vmax = out3.max(axis=(1, 2), keepdims=True)
+    rng = vmax - vmin
+    scale = np.divide(beta - alpha, rng, out=np.zeros_like(rng), where=rng > 0)
+    np.subtract(out3, vmin, out=out3)
+    np.multiply(out3, scale, out=out3)
+    if alpha:
+        np.add(out3, alpha, out=out3)
+    return out
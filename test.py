@@ -20,6 +20,7 @@ from PIL import Image
 import numpy as np
 import scipy.io as sio
 from networks import make_mask, downsampling
+from preprocess import minmax_normalize
 # os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
 parser = argparse.ArgumentParser()
@@ -95,6 +96,7 @@ for motion_name in sorted(os.listdir(opts.input)):
     # motion = motion_mat['data']
     motion = np.float32(motion)
     # motion = np.transpose(motion, [2,0,1])
+    motion_norm = minmax_normalize(motion, device='cuda:%d' % trainer.gpuid)  # all slices at once, on the GPU
 
     num = len(motion)
 
@@ -105,19 +107,10 @@ for motion_name in sorted(os.listdir(opts.input)):
 
     for i in range(num):
         print(i)
-        motion_slice_tem = motion[i,:,:]
-
-
-        motion_slice = np.zeros(motion_slice_tem.shape, dtype=np.float32)
-        cv2.normalize(motion_slice_tem, motion_slice, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-
-        motion_slice = np.expand_dims(np.expand_dims(motion_slice,0),0)
-
-        input = torch.from_numpy(motion_slice).cuda(trainer.gpuid)
-        # input = torch.from_numpy(motion_slice).cuda()
+        input = motion_norm[i:i+1].unsqueeze(0)  # 1x1xHxW
 
         for j in range(trainer.N):
-            mask_test = make_mask(input, trainer.R, trainer.gpuid)
+            mask_test = trainer.draw_mask(input, j)  # fixed bank entries, same masks for every checkpoint
             input_d = downsampling(input, mask_test)
             # content = encode(input_d)
             content = encode(input)
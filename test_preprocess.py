@@ -0,0 +1,43 @@
+"""
+minmax_normalize against cv2.normalize, and the caller's volume is left alone unless inplace is set.
+
+python -m pytest -q test_preprocess.py
+"""
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from preprocess import minmax_normalize
+
+
+def volume(dtype=np.float32):
+    v = (np.arange(3 * 4 * 5).reshape(3, 4, 5) * 10).astype(dtype)
+    v[1] = 7  # constant slice, maps to alpha
+    return v
+
+
+def reference(v):
+    return np.stack([cv2.normalize(np.float32(s), None, 0, 1, cv2.NORM_MINMAX) for s in v])
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64, np.uint16])
+@pytest.mark.parametrize('kind, device', [('numpy', None), ('numpy', 'cpu'), ('tensor', None), ('tensor', 'cpu')])
+def test_not_inplace_leaves_input_unchanged(dtype, kind, device):
+    v = volume(dtype)
+    inp = v.copy() if kind == 'numpy' else torch.from_numpy(v.copy())
+    out = minmax_normalize(inp, device=device)
+    out = out.cpu().numpy() if torch.is_tensor(out) else out
+    original = inp.numpy() if torch.is_tensor(inp) else inp
+    assert np.array_equal(original, v)
+    assert np.allclose(out, reference(v), atol=1e-6)
+
+
+@pytest.mark.parametrize('kind', ['numpy', 'tensor'])
+def test_inplace(kind):
+    v = volume()
+    inp = v.copy() if kind == 'numpy' else torch.from_numpy(v.copy())
+    out = minmax_normalize(inp, inplace=True)
+    original = inp.numpy() if torch.is_tensor(inp) else inp
+    assert np.allclose(original, reference(v), atol=1e-6)
+    assert np.shares_memory(original, out.numpy() if torch.is_tensor(out) else out)
@@ -0,0 +1,53 @@
+"""
+losses.projection_loss against the per-sample loop my_sum_loss of UNIT_Trainer.gen_update was computed with before.
+
+python -m pytest -q test_projection_loss.py
+"""
+import pytest
+import torch
+
+from losses import projection_loss
+
+
+def loop_sum_loss(x_a, x_ab, x_b, x_ba):
+    # former my_sum_loss of gen_update, one sample at a time
+    my_sum_loss = 0
+    for input, target in ((x_a, x_ab), (x_b, x_ba)):
+        for index in range(input.shape[0]):
+            input_tem = input[index, :, :, :].squeeze()
+            target_tem = target[index, :, :, :].squeeze()
+            sum_a_ori = torch.sum(input_tem, dim=0)
+            sum_a_now = torch.sum(target_tem, dim=0)
+            max_a_ori = torch.max(sum_a_ori)
+            max_a_now = torch.max(sum_a_now)
+            sum_a_ori = sum_a_ori / max_a_ori
+            sum_a_now = sum_a_now / max_a_now
+            my_sum_loss = my_sum_loss + torch.sum(abs(sum_a_ori - sum_a_now))
+    return my_sum_loss / (x_b.shape[0] * 2.0)
+
+
+def batched_sum_loss(x_a, x_ab, x_b, x_ba):
+    # my_sum_loss as gen_update computes it now
+    return (projection_loss(x_a, x_ab) + projection_loss(x_b, x_ba)) / (x_b.shape[0] * 2.0)
+
+
+@pytest.mark.parametrize('batch_size, height, width', [(1, 64, 96), (2, 128, 128), (4, 128, 128), (8, 256, 320)])
+def test_projection_loss_matches_loop(batch_size, height, width):
+    torch.manual_seed(batch_size)
+    imgs = [torch.rand(batch_size, 1, height, width, dtype=torch.float64, requires_grad=True) for _ in range(4)]
+
+    loss_loop = loop_sum_loss(*imgs)
+    grads_loop = torch.autograd.grad(loss_loop, imgs)
+    loss_batched = batched_sum_loss(*imgs)
+    grads_batched = torch.autograd.grad(loss_batched, imgs)
+
+    assert torch.allclose(loss_batched, loss_loop, rtol=1e-12, atol=1e-12)
+    for grad_batched, grad_loop in zip(grads_batched, grads_loop):
+        assert torch.allclose(grad_batched, grad_loop, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('batch_size', [1, 4, 8])
+def test_projection_loss_float32(batch_size):
+    torch.manual_seed(batch_size)
+    imgs = [torch.rand(batch_size, 1, 128, 128) for _ in range(4)]
+    assert torch.allclose(batched_sum_loss(*imgs), loop_sum_loss(*imgs), rtol=1e-6, atol=1e-6)
@@ -1,4 +1,4 @@
-from utils import get_all_data_loaders, prepare_sub_folder, write_html, write_loss, get_config, write_2images, Timer, data_prefetcher,get_dataloaders
+from utils import get_all_data_loaders, prepare_sub_folder, write_html, write_loss, get_config, write_2images, Timer, data_prefetcher,get_dataloaders,get_train_prefetcher
 import argparse
 from torch.autograd import Variable
 # from trainer import UNIT_Trainer
@@ -71,8 +71,7 @@ def main():
     # Start training
     iterations = opts.start_epoch
 
-    TraindataA = data_prefetcher(train_loader_a,config)
-    TraindataB = data_prefetcher(train_loader_b,config)
+    TraindataAB = get_train_prefetcher(train_loader_a, train_loader_b, config)
     # testdataA = data_prefetcher(test_loader_a,config)
     # testdataB = data_prefetcher(test_loader_b,config)
 
@@ -93,13 +92,7 @@ def main():
     loss_dis_adv_b = []
 
     while True:
-        dataA = TraindataA.next()  #torch.Size([2, 1, 64, 64]) torch.float64
-        dataB = TraindataB.next()  #torch.Size([2, 1, 64, 64]) torch.float64
-        if dataA is None or dataB is None:
-            TraindataA = data_prefetcher(train_loader_a,config)
-            TraindataB = data_prefetcher(train_loader_b,config)
-            dataA = TraindataA.next()
-            dataB = TraindataB.next()
+        dataA, dataB = TraindataAB.next()  #torch.Size([2, 1, 64, 64]) torch.float64
         with Timer("Elapsed time in update: %f"):
             # Main training code
             for _ in range(1):
@@ -119,7 +112,7 @@ def main():
 
         # Dump training stats in log file
         if (iterations + 1) % config['log_iter'] == 0:
-            print("Iteration: %08d/%08d" % (iterations + 1, max_iter))
+            print("Iteration: %08d/%08d, data wait: %.3fs" % (iterations + 1, max_iter, TraindataAB.wait_time))
         # if (iterations + 1) % config['image_save_iter'] == 0:
         #     testa = testdataA.next()
         #     testb = testdataB.next()
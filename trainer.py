@@ -11,7 +11,8 @@ from GaussianSmoothLayer import GaussionSmoothLayer, GradientLoss
 import os
 # from skimage.measure import  compare_ssim
 import numpy as np
-from networks import make_mask, downsampling, GenMask
+from networks import make_mask, downsampling, downsampling_multi, GenMask, MaskBank, VGGFeatures
+from losses import projection_loss
 
 class UNIT_Trainer(nn.Module):
     def __init__(self, hyperparameters):
@@ -20,13 +21,36 @@ class UNIT_Trainer(nn.Module):
         # Initiate the networks
         self.gen_a = VAEGen(hyperparameters['input_dim_a'], hyperparameters['gen'])  # auto-encoder for domain a
         self.gen_b = VAEGen(hyperparameters['input_dim_b'], hyperparameters['gen'])  # auto-encoder for domain b
-        self.gen_mask = GenMask(hyperparameters['input_dim_a'])  # generate mask
+        self.gen_mask = GenMask(hyperparameters['input_dim_a'],
+                                straight_through=hyperparameters.get('mask_straight_through', False))  # generate mask
         
         self.dis_a = MsImageDis(hyperparameters['input_dim_a'], hyperparameters['dis'])  # discriminator for domain a
         self.dis_b = MsImageDis(hyperparameters['input_dim_b'], hyperparameters['dis'])  # discriminator for domain b
         self.gpuid = hyperparameters['gpuID']
         self.N = hyperparameters['N']
         self.R = hyperparameters['R']
+        # optional pool of precomputed undersampling masks, one bank per image height
+        self.mask_bank_size = hyperparameters.get('mask_bank_size', 0)
+        self.mask_seed = hyperparameters.get('mask_seed', 0)
+        self.mask_banks = {}
+        # optional mixed precision of gen_update/dis_update [none/bf16/fp16]: bf16 on CPU, fp16 falls back to
+        # bf16 without CUDA and bf16 to fp16 on GPUs without bf16; k-space and LayerNorm statistics stay fp32
+        amp = hyperparameters.get('amp', 'none')
+        self.amp_dtype = None
+        if amp in ('bf16', 'fp16'):
+            if not torch.cuda.is_available():
+                self.amp_dtype = torch.bfloat16
+            elif amp == 'fp16' or not torch.cuda.is_bf16_supported():
+                self.amp_dtype = torch.float16
+            else:
+                self.amp_dtype = torch.bfloat16
+        # loss scaling is only needed for the narrow fp16 exponent
+        self.gen_scaler = torch.amp.GradScaler('cuda', enabled=self.amp_dtype == torch.float16)
+        self.dis_scaler = torch.amp.GradScaler('cuda', enabled=self.amp_dtype == torch.float16)
+        # optional torch.compile of gen_forward/dis_forward, a step that fails to compile runs eagerly from then on
+        self.compiled = {}
+        if hyperparameters.get('compile', False):
+            self.compiled = {'gen_forward': torch.compile(self.gen_forward), 'dis_forward': torch.compile(self.dis_forward)}
         # @ add backgound discriminator for each domain
         self.instancenorm = nn.InstanceNorm2d(512, affine=False)
         # Setup the optimizers
@@ -66,14 +90,56 @@ class UNIT_Trainer(nn.Module):
         self.vgg.eval()
         for param in self.vgg.parameters():
             param.requires_grad = False
+        # one VGG pass for the predictions of a step, target features memoized across the calls of a batch
+        self.vgg_features = VGGFeatures(self.vgg, self.instancenorm)
+
+    def draw_mask(self, x, draw=None):
+        """
+        Row masks (BCH1) for undersampling x. Masks come from the mask bank when mask_bank_size > 0,
+        otherwise they are generated on the fly.
+        :param draw: index of an evaluation draw, selects fixed bank entries so that evaluations
+                     use the same masks for every checkpoint
+        """
+        if self.mask_bank_size <= 0:
+            return make_mask(x, self.R, self.gpuid, compact=True)
+        nB, nC, nY = x.shape[0], x.shape[1], x.shape[2]
+        if nY not in self.mask_banks:
+            self.mask_banks[nY] = MaskBank(nY, self.R, self.mask_bank_size, seed=self.mask_seed, device=x.device)
+        bank = self.mask_banks[nY]
+        if draw is None:
+            return bank.sample(nB, nC)
+        index = (draw * nB * nC + torch.arange(nB * nC)) % len(bank)
+        return bank.take(index, nB, nC)
+
+    def autocast(self, x):
+        """
+        Autocast context of the updates on the device of x, disabled unless amp is bf16/fp16
+        """
+        return torch.autocast(x.device.type, dtype=self.amp_dtype or torch.bfloat16, enabled=self.amp_dtype is not None)
+
+    def run_step(self, name, *args):
+        """
+        Run the forward step `name` (gen_forward/dis_forward), compiled when compile is set
+        """
+        step = self.compiled.get(name)
+        if step is not None:
+            try:
+                return step(*args)
+            except Exception as e:
+                print('torch.compile of %s failed, running it eagerly: %s' % (name, e))
+                self.compiled[name] = None
+        return getattr(self, name)(*args)
 
     def recon_criterion(self, input, target):
-        loss1 = torch.mean(torch.abs(input - target))
-        loss2 =  self.compute_vgg_loss(self.vgg, input, target)
-        return loss1+0.5*loss2
+        return self.recon_criteria([(input, target)])[0]
         # return loss1
         # return self.compute_vgg_loss(self.vgg, input, target)
 
+    def recon_criteria(self, pairs):
+        # recon_criterion of several (input, target) pairs, the VGG features of all inputs in one pass
+        loss2 = self.vgg_features.distances(pairs)
+        return [torch.mean(torch.abs(input - target)) + 0.5 * vgg_loss for (input, target), vgg_loss in zip(pairs, loss2)]
+
     def ssim_criterion(self, input, target):
         loss_ssim = 0
         for index in range(input.shape[0]):
@@ -95,22 +161,9 @@ class UNIT_Trainer(nn.Module):
         # self.train()
         return x_ab #, x_ba
 
-    # def gen_update(self, x_a, x_b, hyperparameters):
-    # def gen_update(self, x_a, x_b, hyperparameters, loss_gen_adv_a, loss_gen_adv_b, loss_gen_recon_x_a,
-    #                    loss_gen_recon_kl_a, loss_gen_recon_kl_b, loss_gen_recon_kl_sty, loss_gen_recon_kl_cyc_aba,
-    #                    loss_gen_recon_kl_cyc_bab, loss_gen_recon_kl_cyc_sty, loss_gen_recon_x_b, loss_gen_cyc_x_a,
-    #                    loss_gen_cyc_x_b, loss_gen_vgg_a, loss_gen_vgg_b, loss_bgm, loss_ContentD, loss_gen_total,
-    #                    my_loss_bgm):
-    def gen_update(self, x_a, x_b, hyperparameters, loss_gen_adv_a, loss_gen_adv_b, loss_gen_recon_x_a,loss_gen_recon_x_b, loss_gen_cyc_x_a,
-                   loss_gen_cyc_x_b,loss_gen_total,my_sum_loss):
-
-        self.gen_opt.zero_grad()
-
-        # downsampling
-        mask = make_mask(x_a, self.R, self.gpuid)  # motion img generate mask
-        # mask = self.gen_mask(x_a)           # motion img generate mask
-        x_a_d = downsampling(x_a, mask)
-        x_b_d = downsampling(x_b, mask)
+    # forward pass and losses of gen_update, the part that run_step may compile
+    def gen_forward(self, x_a, x_b, mask, hyperparameters):
+        x_a_d, x_b_d = downsampling_multi([x_a, x_b], mask)
 
         # encode
         h_a = self.gen_a.encode_cont(x_a_d)
@@ -140,8 +193,7 @@ class UNIT_Trainer(nn.Module):
         # downsampling
         # mask_ba = make_mask(x_ba, self.R, self.gpuid)  # motion img generate mask
         # mask_ba = self.gen_mask(x_ba)           # motion img generate mask
-        x_ba_d = downsampling(x_ba, mask)
-        x_ab_d = downsampling(x_ab, mask)
+        x_ba_d, x_ab_d = downsampling_multi([x_ba, x_ab], mask)
 
         # encode again
         h_b_recon = self.gen_a.encode_cont(x_ba_d)
@@ -158,12 +210,15 @@ class UNIT_Trainer(nn.Module):
         x_aba = (self.gen_a.decode_recs(h_a_cat_recs)) if hyperparameters['recon_x_cyc_w'] > 0 else None
         x_bab = (self.gen_b.decode_cont(h_b_recon)) if hyperparameters['recon_x_cyc_w'] > 0 else None
 
-        # reconstruction loss
-        self.loss_gen_recon_x_a = self.recon_criterion(x_a_recon, x_a)
-        self.loss_gen_recon_x_b = self.recon_criterion(x_b_recon, x_b)
+        # reconstruction loss, one VGG pass for all reconstructions
+        pairs = [(x_a_recon, x_a), (x_b_recon, x_b)]
+        if x_aba is not None:
+            pairs += [(x_aba, x_a), (x_bab, x_b)]
+        losses = self.recon_criteria(pairs)
+        self.loss_gen_recon_x_a, self.loss_gen_recon_x_b = losses[0], losses[1]
 
-        self.loss_gen_cyc_x_a = self.recon_criterion(x_aba, x_a) if x_aba is not None else 0
-        self.loss_gen_cyc_x_b = self.recon_criterion(x_bab, x_b) if x_aba is not None else 0
+        self.loss_gen_cyc_x_a = losses[2] if x_aba is not None else 0
+        self.loss_gen_cyc_x_b = losses[3] if x_aba is not None else 0
 
         # GAN loss
         self.loss_gen_adv_a = self.dis_a.calc_gen_loss(x_ba)
@@ -199,30 +254,7 @@ class UNIT_Trainer(nn.Module):
         # self.my_entropy_loss = self.my_entropy_loss/ (x_ab.shape[0] * 2.0)
 
 
-        self.my_sum_loss = 0
-
-        for index in range(x_a.shape[0]):
-            input_tem = x_a[index, :, :, :].squeeze()
-            target_tem = x_ab[index, :, :, :].squeeze()
-            sum_a_ori = torch.sum(input_tem, dim=0)
-            sum_a_now = torch.sum(target_tem, dim=0)
-            max_a_ori = torch.max(sum_a_ori)
-            max_a_now = torch.max(sum_a_now)
-            sum_a_ori = sum_a_ori / max_a_ori
-            sum_a_now = sum_a_now / max_a_now
-            self.my_sum_loss = self.my_sum_loss + torch.sum(abs(sum_a_ori - sum_a_now))
-
-        for index in range(x_b.shape[0]):
-            input_tem = x_b[index, :, :, :].squeeze()
-            target_tem = x_ba[index, :, :, :].squeeze()
-            sum_a_ori = torch.sum(input_tem, dim=0)
-            sum_a_now = torch.sum(target_tem, dim=0)
-            max_a_ori = torch.max(sum_a_ori)
-            max_a_now = torch.max(sum_a_now)
-            sum_a_ori = sum_a_ori / max_a_ori
-            sum_a_now = sum_a_now / max_a_now
-            self.my_sum_loss = self.my_sum_loss + torch.sum(abs(sum_a_ori - sum_a_now))
-
+        self.my_sum_loss = projection_loss(x_a, x_ab) + projection_loss(x_b, x_ba)
         self.my_sum_loss = self.my_sum_loss / (x_b.shape[0] * 2.0)
 
         # self.my_sum_loss -= self.my_sum_loss   # for ablation
@@ -256,6 +288,23 @@ class UNIT_Trainer(nn.Module):
                               0.5*self.my_sum_loss
         # + self.my_entropy_loss
 
+    # def gen_update(self, x_a, x_b, hyperparameters):
+    # def gen_update(self, x_a, x_b, hyperparameters, loss_gen_adv_a, loss_gen_adv_b, loss_gen_recon_x_a,
+    #                    loss_gen_recon_kl_a, loss_gen_recon_kl_b, loss_gen_recon_kl_sty, loss_gen_recon_kl_cyc_aba,
+    #                    loss_gen_recon_kl_cyc_bab, loss_gen_recon_kl_cyc_sty, loss_gen_recon_x_b, loss_gen_cyc_x_a,
+    #                    loss_gen_cyc_x_b, loss_gen_vgg_a, loss_gen_vgg_b, loss_bgm, loss_ContentD, loss_gen_total,
+    #                    my_loss_bgm):
+    def gen_update(self, x_a, x_b, hyperparameters, loss_gen_adv_a, loss_gen_adv_b, loss_gen_recon_x_a,loss_gen_recon_x_b, loss_gen_cyc_x_a,
+                   loss_gen_cyc_x_b,loss_gen_total,my_sum_loss):
+
+        self.gen_opt.zero_grad()
+
+        # downsampling
+        mask = self.draw_mask(x_a)  # motion img generate mask
+        # mask = self.gen_mask(x_a)           # motion img generate mask
+        with self.autocast(x_a):
+            self.run_step('gen_forward', x_a, x_b, mask, hyperparameters)
+
         loss_gen_adv_a.append(hyperparameters['gan_w'] * self.loss_gen_adv_a.item())
         loss_gen_adv_b.append(hyperparameters['gan_w'] * self.loss_gen_adv_b.item())
         loss_gen_recon_x_a.append(hyperparameters['recon_x_w'] * self.loss_gen_recon_x_a.item())
@@ -268,16 +317,15 @@ class UNIT_Trainer(nn.Module):
         my_sum_loss.append(0.5 * self.my_sum_loss.item())
         # my_entropy_loss.append(  self.my_entropy_loss.item())
 
-        self.loss_gen_total.backward()
-        self.gen_opt.step()
+        self.gen_scaler.scale(self.loss_gen_total).backward()
+        self.gen_scaler.step(self.gen_opt)
+        self.gen_scaler.update()
 
     def compute_vgg_loss(self, vgg, img, target):  #torch.Size([2, 1, 64, 64])  torch.Size([2, 1, 64, 64])
-        img_vgg = img.repeat(1, 3, 1, 1)
-        target_vgg = target.repeat(1, 3, 1, 1)
         # img_vgg = vgg_preprocess(img)
         # target_vgg = vgg_preprocess(target)
-        img_fea = vgg(img_vgg)  #torch.Size([2, 512, 8, 8])
-        target_fea = vgg(target_vgg)
+        img_fea = vgg(img)  #torch.Size([2, 512, 8, 8]), the 1-channel vgg takes the images as they are
+        target_fea = vgg(target)
         return torch.mean((self.instancenorm(img_fea) - self.instancenorm(target_fea)) ** 2)
 
     def sample(self, x_a, x_b):
@@ -306,14 +354,9 @@ class UNIT_Trainer(nn.Module):
         self.train()
         return x_a, x_a_recon, x_ab, x_b, x_b_recon, x_ba
 
-    def dis_update(self, x_a, x_b, hyperparameters, loss_dis_a, loss_dis_b):
-        self.dis_opt.zero_grad()
-
-        # downsampling
-        mask_a = make_mask(x_a, self.R, self.gpuid)  # motion img generate mask
-        # mask_a = self.gen_mask(x_a)           # motion img generate mask
-        x_a_d = downsampling(x_a, mask_a)
-        x_b_d = downsampling(x_b, mask_a)
+    # forward pass and losses of dis_update, the part that run_step may compile
+    def dis_forward(self, x_a, x_b, mask_a):
+        x_a_d, x_b_d = downsampling_multi([x_a, x_b], mask_a)
 
         # encode
         h_a = self.gen_a.encode_cont(x_a_d)
@@ -335,12 +378,22 @@ class UNIT_Trainer(nn.Module):
         self.loss_dis_a = self.dis_a.calc_dis_loss(x_ba.detach(), x_a)
         self.loss_dis_b = self.dis_b.calc_dis_loss(x_ab.detach(), x_b)
 
+    def dis_update(self, x_a, x_b, hyperparameters, loss_dis_a, loss_dis_b):
+        self.dis_opt.zero_grad()
+
+        # downsampling
+        mask_a = self.draw_mask(x_a)  # motion img generate mask
+        # mask_a = self.gen_mask(x_a)           # motion img generate mask
+        with self.autocast(x_a):
+            self.run_step('dis_forward', x_a, x_b, mask_a)
+
         loss_dis_a.append(self.loss_dis_a.item())
         loss_dis_b.append(self.loss_dis_b.item())
 
         self.loss_dis_total = hyperparameters['gan_w'] * (self.loss_dis_a + self.loss_dis_b )
-        self.loss_dis_total.backward()
-        self.dis_opt.step()
+        self.dis_scaler.scale(self.loss_dis_total).backward()
+        self.dis_scaler.step(self.dis_opt)
+        self.dis_scaler.update()
 
     def update_learning_rate(self):
         if self.dis_scheduler is not None:
@@ -392,11 +445,10 @@ class UNIT_Trainer(nn.Module):
             self.loss_gen_cyc_x_b_15 = 0
 
             # downsampling
-            for _ in range(15):
-                mask = make_mask(x_a, self.R, self.gpuid)  # motion img generate mask
+            for draw in range(15):
+                mask = self.draw_mask(x_a, draw)  # motion img generate mask
                 # mask = self.gen_mask(x_a)           # motion img generate mask
-                x_a_d = downsampling(x_a, mask)
-                x_b_d = downsampling(x_b, mask)
+                x_a_d, x_b_d = downsampling_multi([x_a, x_b], mask)
 
                 # encode
                 h_a = self.gen_a.encode_cont(x_a_d)
@@ -414,8 +466,7 @@ class UNIT_Trainer(nn.Module):
                 x_ab = self.gen_b.decode_cont(h_a)
 
                 # downsampling
-                x_ba_d = downsampling(x_ba, mask)
-                x_ab_d = downsampling(x_ab, mask)
+                x_ba_d, x_ab_d = downsampling_multi([x_ba, x_ab], mask)
 
                 # encode again
                 h_b_recon = self.gen_a.encode_cont(x_ba_d)
@@ -429,8 +480,8 @@ class UNIT_Trainer(nn.Module):
                 x_aba = (self.gen_a.decode_recs(h_a_cat_recs)) if hyperparameters['recon_x_cyc_w'] > 0 else None
                 x_bab = (self.gen_b.decode_cont(h_b_recon)) if hyperparameters['recon_x_cyc_w'] > 0 else None
 
-                self.loss_gen_cyc_x_a = self.recon_criterion(x_aba, x_a) if x_aba is not None else 0
-                self.loss_gen_cyc_x_b = self.recon_criterion(x_bab, x_b) if x_aba is not None else 0
+                if x_aba is not None:
+                    self.loss_gen_cyc_x_a, self.loss_gen_cyc_x_b = self.recon_criteria([(x_aba, x_a), (x_bab, x_b)])
 
                 self.loss_gen_cyc_x_a_15 += self.loss_gen_cyc_x_a
                 self.loss_gen_cyc_x_b_15 += self.loss_gen_cyc_x_b
@@ -474,8 +525,9 @@ class UNIT_Trainer(nn.Module):
         # self.loss_gen_recon_x_a = self.recon_criterion(x_a_recon, x_a)
         # self.loss_gen_recon_x_b = self.recon_criterion(x_b_recon, x_b)
 
-        self.loss_gen_cyc_x_a_no = self.recon_criterion(x_aba_no, x_a) if x_aba is not None else 0
-        self.loss_gen_cyc_x_b_no = self.recon_criterion(x_bab_no, x_b) if x_aba is not None else 0
+        self.loss_gen_cyc_x_a_no, self.loss_gen_cyc_x_b_no = 0, 0
+        if x_aba is not None:
+            self.loss_gen_cyc_x_a_no, self.loss_gen_cyc_x_b_no = self.recon_criteria([(x_aba_no, x_a), (x_bab_no, x_b)])
 
         loss_gen_cyc_x_a[2].append(hyperparameters['recon_x_cyc_w'] * self.loss_gen_cyc_x_a_no.item())
         loss_gen_cyc_x_b[2].append(hyperparameters['recon_x_cyc_w'] * self.loss_gen_cyc_x_b_no.item())
\ No newline at end of file
@@ -3,7 +3,7 @@ from networks import vgg_19
 from torch.autograd import Variable
 from torch.optim import lr_scheduler
 from torchvision import transforms
-from data import ImageFilelist, ImageFolder,myImageFolder,mymotionImageFolder,mymotionImageFolder2
+from data import ImageFilelist, ImageFolder,myImageFolder,mymotionImageFolder,mymotionImageFolder2,VolumeCache,LazyMotionImageFolder,VolumeGroupedSampler,PairedDataset,PairedRandomSampler
 import torch
 import os
 import math
@@ -12,6 +12,7 @@ import yaml
 import numpy as np
 import torch.nn.init as init
 import time
+import collections
 
 
 def get_all_data_loaders(conf):
@@ -58,14 +59,14 @@ def get_dataloaders(conf):
     height = conf['crop_image_height']
     width = conf['crop_image_width']
 
-    train_loader_a = my_motion_data_loader_folder(os.path.join(conf['data_root'], 'motion'), batch_size, True,
-                                            new_size_a, height, width, num_workers, True)
-    train_loader_b = my_motion_data_loader_folder2(os.path.join(conf['data_root'], 'gt'), batch_size, True,
-                                            new_size_b, height, width, num_workers, True)
-    test_loader_a = my_motion_data_loader_folder(os.path.join(conf['data_root'], 'motion'), batch_size, False,
-                                           new_size_a, new_size_a, new_size_a, num_workers, True)
-    test_loader_b = my_motion_data_loader_folder2(os.path.join(conf['data_root'], 'gt'), batch_size, False,
-                                           new_size_b, new_size_b, new_size_b, num_workers, True)
+    # train and test loaders read the same folders, every volume is loaded once and shared
+    dataset_a = motion_dataset(os.path.join(conf['data_root'], 'motion'), conf, mymotionImageFolder)
+    dataset_b = motion_dataset(os.path.join(conf['data_root'], 'gt'), conf, mymotionImageFolder2)
+
+    train_loader_a = motion_data_loader(dataset_a, batch_size, True, num_workers, conf)
+    train_loader_b = motion_data_loader(dataset_b, batch_size, True, num_workers, conf)
+    test_loader_a = motion_data_loader(dataset_a, batch_size, False, num_workers, conf)
+    test_loader_b = motion_data_loader(dataset_b, batch_size, False, num_workers, conf)
     return train_loader_a, train_loader_b, test_loader_a, test_loader_b
 
 def get_data_loader_list(root, file_list, batch_size, train, new_size=None,
@@ -101,16 +102,56 @@ def my_data_loader_folder(input_folder, batch_size, train, new_size=None,
     loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=train, drop_last=True, num_workers=num_workers)
     return loader
 
-def my_motion_data_loader_folder(input_folder, batch_size, train, new_size=None,
-                           height=256, width=320, num_workers=4, crop=True):
-    dataset = mymotionImageFolder(input_folder)
-    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=train, drop_last=True, num_workers=num_workers)
+def worker_options(conf, num_workers, train):
+    # training loaders keep their workers alive across epochs, see infinite_loader
+    if num_workers == 0 or not train:
+        return {}
+    return {'persistent_workers': True, 'prefetch_factor': conf.get('loader_prefetch_factor', 2)}
+
+def motion_dataset(input_folder, conf, folder_class=mymotionImageFolder):
+    """
+    Dataset over a folder of motion/gt volumes, set up from the data options of the config
+    (preprocess cache, lazy loading, slice store and parallel ingestion).
+    """
+    cache = None
+    if conf.get('preprocess_cache_dir'):
+        cache = VolumeCache(conf['preprocess_cache_dir'], conf.get('preprocess_cache_max_gb', 0) * 1024 ** 3)
+    if conf.get('lazy_cache_volumes', 0) > 0:
+        return LazyMotionImageFolder(input_folder, conf['lazy_cache_volumes'], cache)
+    return folder_class(input_folder, conf.get('slice_store_dir'), cache,
+                        conf.get('ingest_workers', 0), conf.get('ingest_pool', 'thread'))
+
+def lazy_sampler(dataset, train):
+    # lazy datasets are shuffled volume-window by volume-window so that their volume cache gets hits
+    if not train or not isinstance(dataset, LazyMotionImageFolder):
+        return None
+    return VolumeGroupedSampler(dataset, dataset.max_volumes)
+
+def motion_data_loader(dataset, batch_size, train, num_workers, conf):
+    sampler = lazy_sampler(dataset, train)
+    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=train and sampler is None, sampler=sampler,
+                        drop_last=True, num_workers=num_workers,
+                        pin_memory=torch.cuda.is_available(), **worker_options(conf, num_workers, train))
     return loader
 
+def my_motion_data_loader_folder(input_folder, batch_size, train, new_size=None,
+                           height=256, width=320, num_workers=4, crop=True, conf=None):
+    dataset = motion_dataset(input_folder, conf or {}, mymotionImageFolder)
+    return motion_data_loader(dataset, batch_size, train, num_workers, conf or {})
+
 def my_motion_data_loader_folder2(input_folder, batch_size, train, new_size=None,
-                           height=256, width=320, num_workers=4, crop=True):
-    dataset = mymotionImageFolder2(input_folder)
-    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=train, drop_last=True, num_workers=num_workers)
+                           height=256, width=320, num_workers=4, crop=True, conf=None):
+    dataset = motion_dataset(input_folder, conf or {}, mymotionImageFolder2)
+    return motion_data_loader(dataset, batch_size, train, num_workers, conf or {})
+
+def paired_data_loader(dataset_a, dataset_b, conf, train=True):
+    dataset = PairedDataset(dataset_a, dataset_b)
+    sampler = PairedRandomSampler(len(dataset_a), len(dataset_b), shuffle=train,
+                                  sampler_a=lazy_sampler(dataset_a, train), sampler_b=lazy_sampler(dataset_b, train))
+    num_workers = conf['num_workers']
+    loader = DataLoader(dataset=dataset, batch_size=conf['batch_size'], sampler=sampler, drop_last=True,
+                        num_workers=num_workers, pin_memory=torch.cuda.is_available(),
+                        **worker_options(conf, num_workers, train))
     return loader
 
 def get_data_loader_folder_Colorjit(input_folder, batch_size, train, new_size=None,
@@ -127,26 +168,168 @@ def get_data_loader_folder_Colorjit(input_folder, batch_size, train, new_size=No
     loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=train, drop_last=True, num_workers=num_workers)
     return loader
 
+def infinite_loader(loader):
+    """
+    Iterate over a DataLoader epoch after epoch. With persistent_workers the worker processes
+    survive the epoch boundary, the sampler just reshuffles and the workers keep prefetching.
+    """
+    while True:
+        empty = True
+        for batch in loader:
+            empty = False
+            yield batch
+        if empty:  # would spin forever
+            raise RuntimeError('the data loader yielded no batch in a whole epoch '
+                               '(batch_size larger than the dataset with drop_last?)')
+
+
 class data_prefetcher():
-    def __init__(self, loader,config):
+    """
+    Keeps up to `depth` batches of a DataLoader in flight. On GPU hosts batches are copied from
+    pinned host memory with non_blocking copies on a side stream; on CPU-only hosts they are
+    returned as loaded. next() returns None when the loader is exhausted, unless `loop` is set:
+    then epochs follow each other without end (see infinite_loader).
+    wait_time accumulates the seconds the training loop spent blocked in next().
+    """
+    def __init__(self, loader, config, depth=None, loop=False):
         self.config = config
-        self.loader = iter(loader)
-        self.stream = torch.cuda.Stream()
-        self.preload()
+        self.loader = infinite_loader(loader) if loop else iter(loader)
+        self.depth = max(1, depth if depth is not None else config.get('prefetch_depth', 1))
+        self.use_cuda = torch.cuda.is_available()
+        if self.use_cuda:
+            self.device = torch.device('cuda', config['gpuID'])
+            self.stream = torch.cuda.Stream(device=self.device)
+        self.queue = collections.deque()
+        self.wait_time = 0.
+        self.batches = 0
+        for _ in range(self.depth):
+            self.preload()
+
     def next(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        input = self.next_input
+        start = time.time()
+        if not self.queue:
+            return None
+        input, ready = self.queue.popleft()
+        if self.use_cuda:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(ready)
+            for tensor in (input if isinstance(input, (list, tuple)) else [input]):
+                tensor.record_stream(current)  # memory was allocated on the side stream
         self.preload()
+        self.wait_time += time.time() - start
+        self.batches += 1
         return input
+
+    def to_device(self, input):
+        # a batch is a tensor, or a list of tensors for the paired loader
+        if isinstance(input, (list, tuple)):
+            return [self.to_device(tensor) for tensor in input]
+        if not input.is_pinned():
+            input = input.pin_memory()
+        return input.to(self.device, non_blocking=True)
+
     def preload(self):
         try:
-            self.next_input = next(self.loader)
+            input = next(self.loader)
         except StopIteration:
-            self.next_input = None
-            return 
-        with torch.cuda.stream(self.stream):
-            # self.next_input = self.next_input.cuda(non_blocking=True)
-            self.next_input = self.next_input.cuda(self.config['gpuID'])
+            return
+        ready = None
+        if self.use_cuda:
+            with torch.cuda.stream(self.stream):
+                input = self.to_device(input)
+                ready = torch.cuda.Event()
+                ready.record(self.stream)
+        self.queue.append((input, ready))
+
+
+class gpu_patch_sampler():
+    """
+    Drop-in replacement for data_prefetcher on the random-crop datasets: all normalized slices
+    are uploaded to the device once, and every batch is cut out with one vectorized gather.
+    Slice order and crop offsets are drawn per epoch; next() never returns None, a new
+    epoch starts when the current one is exhausted.
+    """
+    def __init__(self, dataset, config, margin=10):
+        assert hasattr(dataset, 'motion'), "gpu_patch_sampler needs an eager or slice store dataset"
+        if torch.cuda.is_available():
+            self.device = torch.device('cuda', config['gpuID'])
+        else:
+            self.device = torch.device('cpu')
+        self.batch_size = config['batch_size']
+        self.height = config['crop_image_height']
+        self.width = config['crop_image_width']
+        self.margin = margin
+        slices = dataset.motion
+        sizes = np.array([slices[i].shape for i in range(len(slices))], dtype=np.int64)
+        # slices of different shapes are zero padded, crops stay inside each slice's own size
+        self.slices = torch.zeros((len(slices), sizes[:, 0].max(), sizes[:, 1].max()), device=self.device)
+        for i in range(len(slices)):
+            self.slices[i, :sizes[i, 0], :sizes[i, 1]].copy_(torch.from_numpy(np.array(slices[i])))
+        self.sizes = torch.from_numpy(sizes).to(self.device)
+        self.wait_time = 0.
+        self.batches = 0
+        self.rows = torch.arange(self.height, device=self.device).view(1, -1, 1)
+        self.cols = torch.arange(self.width, device=self.device).view(1, 1, -1)
+        self.new_epoch()
+
+    def new_epoch(self):
+        n = self.slices.shape[0]
+        assert n >= self.batch_size, "gpu_patch_sampler: {} slices, fewer than batch_size {}".format(n, self.batch_size)
+        self.order = torch.randperm(n, device=self.device)[:n // self.batch_size * self.batch_size]  # drop_last
+        size = self.sizes[self.order]
+        # same range as random.randint(margin, size - crop - margin)
+        span_h = (size[:, 0] - self.height - 2 * self.margin + 1).float()
+        span_w = (size[:, 1] - self.width - 2 * self.margin + 1).float()
+        self.top = self.margin + (torch.rand(len(self.order), device=self.device) * span_h).long()
+        self.left = self.margin + (torch.rand(len(self.order), device=self.device) * span_w).long()
+        self.pos = 0
+
+    def next(self):
+        start = time.time()
+        if self.pos >= len(self.order):
+            self.new_epoch()
+        batch = slice(self.pos, self.pos + self.batch_size)
+        self.pos += self.batch_size
+        rows = self.top[batch].view(-1, 1, 1) + self.rows
+        cols = self.left[batch].view(-1, 1, 1) + self.cols
+        patches = self.slices[self.order[batch].view(-1, 1, 1), rows, cols]
+        self.wait_time += time.time() - start
+        self.batches += 1
+        return patches.unsqueeze(1)
+
+
+def get_prefetcher(loader, config):
+    # batches of the training loop, from the DataLoader or straight from device memory
+    if config.get('gpu_sampler', False):
+        return gpu_patch_sampler(loader.dataset, config)
+    return data_prefetcher(loader, config, loop=True)
+
+
+class zip_prefetcher():
+    """
+    (A, B) batches from two independent prefetchers, same interface as a paired prefetcher.
+    """
+    def __init__(self, prefetcher_a, prefetcher_b):
+        self.prefetcher_a = prefetcher_a
+        self.prefetcher_b = prefetcher_b
+
+    def next(self):
+        return self.prefetcher_a.next(), self.prefetcher_b.next()
+
+    @property
+    def wait_time(self):
+        return self.prefetcher_a.wait_time + self.prefetcher_b.wait_time
+
+
+def get_train_prefetcher(train_loader_a, train_loader_b, config):
+    """
+    (A, B) batches for the training loop. With paired_loader, one DataLoader over a PairedDataset
+    yields both domains from a single worker pool; otherwise each domain has its own loader.
+    """
+    if config.get('paired_loader', False) and not config.get('gpu_sampler', False):
+        return data_prefetcher(paired_data_loader(train_loader_a.dataset, train_loader_b.dataset, config),
+                               config, loop=True)
+    return zip_prefetcher(get_prefetcher(train_loader_a, config), get_prefetcher(train_loader_b, config))
 
 def get_config(config):
     with open(config, 'r') as stream:
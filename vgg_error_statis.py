@@ -1,6 +1,7 @@
 # this module is used to caculate the feture 
 # error of each layer in the vgg model
 from utils import vgg_preprocess
+from networks import fold_rgb_conv
 import torchvision
 import torch
 import torch.nn as nn
@@ -15,11 +16,10 @@ class vgg_19(nn.Module):
     def __init__(self):
         super(vgg_19, self).__init__()
         self.vgg_model = torchvision.models.vgg19(pretrained=True)
+        self.vgg_model.features[0] = fold_rgb_conv(self.vgg_model.features[0])  # takes 1-channel images directly
         self.layers = [6,11,20, 29]#
         self.vgg_model.eval()
     def forward(self, x):
-        # if x.size(1) == 1:
-        #     x = torch.cat((x, x, x), 1)
         outfea = []
         for layer in self.layers:
             self.feature_ext = nn.Sequential(*list(self.vgg_model.features.children())[:layer])